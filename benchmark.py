@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+script for timing the slow parts of populate and bake,
+not meant to be in regular use
+"""
+
+import argparse
+import os
+import sys
+
+try:
+    os.environ.pop("DJANGO_SETTINGS_MODULE")
+except Exception:
+    pass
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "proj.settings")
+django.setup()
+
+
+from pi_monitor import benchmark  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load_year = subparsers.add_parser(
+        "load_year", help="compare iterrows and vectorised Value construction"
+    )
+    load_year.add_argument("--jurisdiction", default="foisa")
+
+    links = subparsers.add_parser(
+        "links", help="compare reverse() against the link registry"
+    )
+    links.add_argument("--jurisdiction", default="foisa")
+
+    bake = subparsers.add_parser(
+        "bake", help="time rendering a sample of each view's pages"
+    )
+    bake.add_argument("--sample", type=int, default=20, help="pages per view")
+    bake.add_argument("--output", default="bake_benchmark.json")
+    bake.add_argument("--baseline", help="earlier output to compare against")
+    bake.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction a metric can get worse by before it is flagged",
+    )
+    bake.add_argument("--view", action="append", help="only these view classes")
+
+    workers = subparsers.add_parser(
+        "workers", help="check a bake across workers matches a serial bake"
+    )
+    workers.add_argument("--workers", type=int, default=2)
+    workers.add_argument("--view", action="append", help="only these view classes")
+
+    args = parser.parse_args()
+
+    if args.command == "load_year":
+        benchmark.benchmark_load_year(args.jurisdiction)
+    elif args.command == "links":
+        benchmark.benchmark_links(args.jurisdiction)
+    elif args.command == "bake":
+        regressions = benchmark.benchmark_bake(
+            args.sample, args.output, args.baseline, args.tolerance, args.view
+        )
+        if regressions:
+            sys.exit(1)
+    elif args.command == "workers":
+        if benchmark.benchmark_workers(args.workers, args.view):
+            sys.exit(1)
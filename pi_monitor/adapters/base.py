@@ -1,26 +1,299 @@
+import csv
+import hashlib
+import inspect
 import os
 import markdown
+import numpy as np
 import pandas as pd
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:  # faster csv reading and the cleaned table cache are optional
+    pyarrow = None
+    feather = None
+
+# how many parsed files to keep in memory
+FILE_CACHE_SIZE = 32
+
+_file_cache = OrderedDict()
+
+TABLE_EXTENSION = ".feather"
+
+# data warnings already printed this run
+_reported = set()
+
+
+def report_once(key, message):
+    """
+    print a warning about the data the first time it comes up in a run
+    the same files are read for every year, so it would otherwise repeat
+    """
+    if key not in _reported:
+        _reported.add(key)
+        print(message)
+
+
+def _cache_key(path, kwargs):
+    """
+    key on the file's identity on disk and how it was read
+    """
+    stat = os.stat(path)
+    options = tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, options)
+
+
+def invalidate_file_cache(path=None):
+    """
+    forget parsed files - all of them, or just those for one path
+    """
+    if path is None:
+        _file_cache.clear()
+        return
+    path = os.path.abspath(path)
+    for key in [x for x in _file_cache if x[0] == path]:
+        del _file_cache[key]
+
+
+class CsvSchema(object):
+    """
+    how to read a statistics file
+    the columns that are numbers, the tokens that mean no value,
+    and names for headers that appear more than once (in order)
+    header names are stripped of surrounding spaces, and any other
+    repeats get .1, .2... added, as pandas would name them
+    """
+
+    na_values = ["-", "--", " "]
+
+    def __init__(self, numeric_columns, duplicate_headers=None, thousands=None):
+        self.numeric_columns = sorted(set(numeric_columns))
+        self.duplicate_headers = duplicate_headers or {}
+        self.thousands = thousands
+
+    def __repr__(self):
+        return "CsvSchema({0!r}, {1!r}, {2!r})".format(
+            self.numeric_columns, sorted(self.duplicate_headers.items()), self.thousands
+        )
+
+    def column_names(self, header):
+        seen = defaultdict(int)
+        names = []
+        for h in header:
+            h = h.strip()
+            renames = self.duplicate_headers.get(h)
+            if renames and seen[h] < len(renames):
+                names.append(renames[seen[h]])
+            elif seen[h]:
+                names.append("{0}.{1}".format(h, seen[h]))
+            else:
+                names.append(h)
+            seen[h] += 1
+        return names
+
+    def read_options(self, header):
+        names = self.column_names(header)
+        numeric = set(self.numeric_columns)
+        # header row skipped and named here, as the pyarrow engine
+        # only applies names to files read without a header
+        options = {
+            "header": None,
+            "skiprows": 1,
+            "names": names,
+            "na_values": self.na_values,
+            "dtype": {x: "float64" for x in names if x in numeric},
+        }
+        if self.thousands:
+            options["thousands"] = self.thousands
+        return options
+
+
+def clean_numeric_block(df, columns, na_values=CsvSchema.na_values):
+    """
+    coerce a block of columns to numbers in one pass
+    text columns are stripped and converted together; na_values and
+    blanks become NaN, as does anything else that isn't a number
+    returns the block and how many values in each column weren't numbers
+    """
+    columns = list(columns)
+    block = df[columns]
+    counts = dict.fromkeys(columns, 0)
+    text = [
+        i
+        for i, column in enumerate(columns)
+        if not pd.api.types.is_numeric_dtype(block.iloc[:, i])
+    ]
+    if not text:
+        return block, counts
+
+    raw = block.iloc[:, text].to_numpy(dtype=object)
+    flat = pd.Series(raw.ravel())
+    # text columns can also hold numbers and None, which are left as they are
+    stripped = flat.map(lambda x: x.strip() if isinstance(x, str) else x)
+    numbers = pd.to_numeric(stripped, errors="coerce").to_numpy(dtype=float)
+
+    missing = (flat.isnull() | stripped.isin(list(na_values) + [""])).to_numpy()
+    coerced = (np.isnan(numbers) & ~missing).reshape(raw.shape).sum(axis=0)
+    for i, n in zip(text, coerced):
+        counts[columns[i]] += int(n)
+
+    # join the converted columns back on in one go (setting them one
+    # at a time leaves the frame in hundreds of pieces), then restore the order
+    numbers = pd.DataFrame(numbers.reshape(raw.shape), index=block.index)
+    numbers.columns = [columns[i] for i in text]
+    rest = [i for i in range(len(columns)) if i not in set(text)]
+    position = {x: n for n, x in enumerate(rest + text)}
+    block = pd.concat([block.iloc[:, rest], numbers], axis=1)
+    block = block.iloc[:, [position[i] for i in range(len(columns))]]
+    return block, counts
+
+
+def read_header(path, encoding=None):
+    with open(path, encoding=encoding or "utf-8-sig", newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def read_typed_csv(path, schema, **kwargs):
+    """
+    read a csv with the schema's types - with the pyarrow engine, or
+    pandas' own where pyarrow is missing or can't read the file
+    (e.g. numbers with thousands separators)
+    if a numeric column has something that isn't a number in it,
+    fall back to reading it as text and coercing (as the loaders used to)
+    """
+    options = schema.read_options(read_header(path, kwargs.get("encoding")))
+    options.update(kwargs)
+    if pyarrow is not None and "thousands" not in options:
+        try:
+            return pd.read_csv(path, engine="pyarrow", **options)
+        except ValueError:
+            pass
+    dtype = options.pop("dtype", None)
+    try:
+        return pd.read_csv(path, dtype=dtype, **options)
+    except ValueError:
+        if not dtype:
+            raise
+    # read the numeric columns as text and coerce them
+    df = pd.read_csv(path, **options)
+    for column in dtype:
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+    report_once(path, "{0}: some numeric columns had text in them".format(path))
+    return df
 
 
 def load_file(*args, **kwargs):
     """
     Load a file (CSV or Excel) based on file extension
+
+    Files are parsed once per process and a copy handed out after that,
+    so callers are free to modify what they get back.
+    Pass cache=False to always read from disk.
+    Pass a CsvSchema as schema to read a CSV with typed columns.
     """
-    lower_case_columns = kwargs.pop("lower_case_columns", False)
+    use_cache = kwargs.pop("cache", True)
     path = os.path.join(*args)
+
+    key = _cache_key(path, kwargs) if use_cache else None
+    if key in _file_cache:
+        _file_cache.move_to_end(key)
+        return _file_cache[key].copy()
+
+    lower_case_columns = kwargs.pop("lower_case_columns", False)
+    schema = kwargs.pop("schema", None)
     print("Opening : {path}".format(path=path))
     ext = os.path.splitext(path)[1]
     if ext in [".xlsx", ".xls"]:
         df = pd.read_excel(path, **kwargs)
+    elif schema is not None:
+        df = read_typed_csv(path, schema, **kwargs)
     else:  # Default to CSV
         df = pd.read_csv(path, **kwargs)
     if lower_case_columns:
         df.columns = [x.lower().strip() for x in df.columns]
+
+    if use_cache:
+        _file_cache[key] = df
+        while len(_file_cache) > FILE_CACHE_SIZE:
+            _file_cache.popitem(last=False)
+        return df.copy()
     return df
 
 
+def file_digest(path):
+    """
+    hash of a file's contents
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def table_key(adapter, year):
+    """
+    key for a cleaned year - the adapter and its code, its input files,
+    the column types from the properties file and the shared loading code
+    the database ids don't go in, so a repopulate can reuse the tables
+    """
+    h = hashlib.sha256()
+    cls = adapter.__class__
+    h.update("{0}.{1}|{2}".format(cls.__module__, cls.__qualname__, year).encode())
+    h.update(adapter.year_digest(year).encode())
+    h.update(adapter.digest([adapter.property_desc_file]).encode())
+    h.update(file_digest(inspect.getsourcefile(cls)).encode())
+    h.update(file_digest(__file__).encode())
+    return h.hexdigest()
+
+
+def arrow_safe(df):
+    """
+    object columns that mix strings and numbers can't be written to arrow,
+    so store them as strings (missing values stay missing)
+    everything reading these tables coerces numbers from strings anyway
+    """
+    df = df.reset_index(drop=True)
+    df.columns = [str(x) for x in df.columns]
+    for column in df.columns:
+        s = df[column]
+        if s.dtype == object:
+            df[column] = s.where(s.isnull(), s.astype(str))
+    return df
+
+
+def read_table(path):
+    """
+    read a cached table, memory mapped
+    """
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+
+def write_table(df, path):
+    """
+    write a table for read_table, replacing older versions of it
+    returns False (and writes nothing) if it can't be stored
+    """
+    folder = os.path.dirname(path)
+    prefix = os.path.basename(path).rsplit("-", 1)[0] + "-"
+    os.makedirs(folder, exist_ok=True)
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        feather.write_feather(arrow_safe(df), tmp, compression="uncompressed")
+    except (TypeError, ValueError) as e:
+        print("not caching {0}: {1}".format(os.path.basename(path), e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    os.replace(tmp, path)
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name.endswith(TABLE_EXTENSION):
+            if os.path.join(folder, name) != path:
+                os.remove(os.path.join(folder, name))
+    return True
+
+
 def dataframe_to_map(df, col1name, col2name, default=None):
     """
     Create a dictionary mapping from two columns of a DataFrame
@@ -71,11 +344,57 @@ class GenericAdapter(object):
     description_loc = "description.md"
     data_source = ""
     geo_label = ""
+    # headers used more than once in the year data, and what to call each use
+    duplicate_headers = {}
+    thousands = None
 
     def __init__(self, resources_folder):
         self.resources_folder = resources_folder
         self.data_source = self.__class__.data_source
 
+    def invalidate_files(self):
+        """
+        drop any cached copies of this adapter's resource files
+        """
+        prefix = os.path.abspath(self.resources_folder) + os.sep
+        for key in [x for x in _file_cache if x[0].startswith(prefix)]:
+            del _file_cache[key]
+
+    def structure_files(self):
+        """
+        files that define the properties and authorities
+        """
+        return [self.property_desc_file, self.authorites_desc_file]
+
+    def year_files(self, year: int):
+        """
+        files the values for a year are built from
+        adapters should narrow this down - by default it's everything
+        """
+        return [
+            x
+            for x in os.listdir(self.resources_folder)
+            if os.path.isfile(os.path.join(self.resources_folder, x))
+        ]
+
+    def digest(self, files):
+        """
+        combined hash of some resource files
+        the adapter's code isn't included - adding a year means editing
+        end_year, which shouldn't rebuild the years already loaded
+        """
+        h = hashlib.sha256()
+        for name in sorted(set(files)):
+            h.update(name.encode("utf-8"))
+            h.update(file_digest(os.path.join(self.resources_folder, name)).encode())
+        return h.hexdigest()
+
+    def structure_digest(self):
+        return self.digest(self.structure_files())
+
+    def year_digest(self, year: int):
+        return self.digest(self.year_files(year))
+
     def get_description(self):
         """
         get markdown description
@@ -91,6 +410,65 @@ class GenericAdapter(object):
     def get_properties(self):
         return load_file(self.resources_folder, self.property_desc_file)
 
+    def schema(self):
+        """
+        how to read the year data - the properties that
+        aren't calculated from others are numeric columns
+        """
+        properties = self.get_properties()
+        numeric = properties.loc[properties["combo_of"].isnull(), "value"]
+        return CsvSchema(
+            [x.strip() for x in numeric], self.duplicate_headers, self.thousands
+        )
+
+    def table_path(self, folder, year: int):
+        return os.path.join(
+            folder,
+            "{0}-{1}-{2}{3}".format(
+                self.slug,
+                year,
+                table_key(self, year)[:16],
+                TABLE_EXTENSION,
+            ),
+        )
+
+    def cleaned_year(self, year: int, authority_lookup: dict, folder=None):
+        """
+        get_year, through a cache of cleaned tables in folder
+        the cache is skipped without a folder or pyarrow
+        """
+        if folder is None or feather is None:
+            return self.get_year(year, authority_lookup)
+        path = self.table_path(folder, year)
+        if os.path.exists(path):
+            print("Reading cleaned : {path}".format(path=path))
+            return read_table(path)
+        df = self.get_year(year, authority_lookup)
+        write_table(df, path)
+        return df
+
+    def clean_numeric(self, df, columns=None):
+        """
+        convert numeric columns (by default, those the schema declares)
+        to numbers in one block, reporting columns with values that
+        weren't numbers (once a run)
+        """
+        if columns is None:
+            columns = [x for x in self.schema().numeric_columns if x in df.columns]
+        columns = list(columns)
+        block, counts = clean_numeric_block(df, columns)
+        order = list(df.columns)
+        df = pd.concat([df.drop(columns=columns), block], axis=1)[order]
+        for column, n in counts.items():
+            if n:
+                report_once(
+                    (self.slug, column),
+                    "{0}: {1} values in '{2}' weren't numbers".format(
+                        self.slug, n, column
+                    ),
+                )
+        return df
+
     def get_year(self, year: int, authority_lookup: dict):
         """
         return a pandas DataFrame with information for authorities in the year.
@@ -3,19 +3,6 @@ import numpy as np
 import pandas as pd
 
 
-def zero_if_none(v):
-    """
-    return 0 if none
-    """
-    if v:
-        if v != "-":
-            return int(v)
-        else:
-            return 0
-    else:
-        return 0
-
-
 @AdapterRegistry.register
 class CabinetAdapter(GenericAdapter):
     """
@@ -34,9 +21,18 @@ class CabinetAdapter(GenericAdapter):
     avaliable_types = public_types + private_types
     data_source = "Cabinet Office FOI statistics"
     geo_label = "UK goverment"
+    thousands = ","
+
+    def year_files(self, year: int):
+        return [
+            self.filename,
+            self.authorites_desc_file,
+            self.property_desc_file,
+            "wdtk_year_count.csv",
+        ]
 
     def get_year(self, year: int, authority_lookup: dict):
-        df = load_file(self.resources_folder, self.filename)
+        df = load_file(self.resources_folder, self.filename, schema=self.schema())
         df = df.rename(
             columns={'Total "resolvable" requests': "Total resolvable requests"}
         )
@@ -66,11 +62,8 @@ class CabinetAdapter(GenericAdapter):
         def default_self(x):
             return alt_name_lookup.get(x, x)
 
-        # convert to floats
-        for col in df.columns[2:]:
-            df.loc[df[col] == "-", col] = 0
-            df.loc[df[col] == " ", col] = 0
-            df[col] = pd.to_numeric(df[col])
+        # convert to floats ("-" and blanks are summed as 0 below)
+        df = self.clean_numeric(df, df.columns[2:])
 
         df["Government body"] = df["Government body"].apply(default_self)
 
@@ -98,12 +91,6 @@ class CabinetAdapter(GenericAdapter):
         ]
         df["Public Information Requests"] = df["Total requests received"]
 
-        df["20-day deadline met"] = pd.to_numeric(
-            df["20-day deadline met"], errors="coerce"
-        )
-        df["Permitted extension to 20-day deadline"] = pd.to_numeric(
-            df["Permitted extension to 20-day deadline"], errors="coerce"
-        )
         df["On time (including extentions)"] = (
             df["20-day deadline met"] + df["Permitted extension to 20-day deadline"]
         )
@@ -117,7 +104,9 @@ class CabinetAdapter(GenericAdapter):
         ] = 0
 
         if year == 9999:
-            pt = df.pivot_table(index=["Government body"], aggfunc=np.sum)
+            # the pivot comes back a column per block - join them up
+            # before adding to it
+            pt = df.pivot_table(index=["Government body"], aggfunc=np.sum).copy()
             pt["Government body"] = pt.index
             pt["Sector"] = pt["Government body"].map(sector_lookup)
             df = pt
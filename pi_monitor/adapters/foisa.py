@@ -3,16 +3,6 @@ import pandas as pd
 import numpy as np
 
 
-def zero_if_none(v):
-    """
-    return 0 if none
-    """
-    if v:
-        return int(v)
-    else:
-        return 0
-
-
 @AdapterRegistry.register
 class FoisaAdapter(GenericAdapter):
     """
@@ -30,14 +20,38 @@ class FoisaAdapter(GenericAdapter):
     avaliable_types = public_types + private_types
     data_source = "OSIC FOI Statistics"
     geo_label = "Scotland"
-
-    def get_year(self, year: int, authority_lookup: dict):
+    # the same exemptions appear under FOISA and then EIR
+    duplicate_headers = {
+        "Personal data of the applicant": [
+            "Personal data of the applicant - FOI",
+            "Personal data of the applicant - EIR",
+        ],
+        "Third party personal data": [
+            "Third party personal data - FOI",
+            "Third party personal data - EIR",
+        ],
+    }
+
+    def year_filename(self, year: int):
         if year == 9999:
             filename = "all time"
         else:
             filename = year
+        return "{year}.csv".format(year=filename)
+
+    def year_files(self, year: int):
+        return [
+            self.year_filename(year),
+            "authorities.csv",
+            self.property_desc_file,
+            "wdtk_year_count.csv",
+        ]
 
-        df = load_file(self.resources_folder, "{year}.csv".format(year=filename))
+    def get_year(self, year: int, authority_lookup: dict):
+        df = load_file(
+            self.resources_folder, self.year_filename(year), schema=self.schema()
+        )
+        df = self.clean_numeric(df)
 
         fill_na = [
             "EIR requests",
@@ -92,32 +106,4 @@ class FoisaAdapter(GenericAdapter):
         df = pd.merge(
             df, wdtk_df, how="left", left_on=["authority_id"], right_on=["authority_id"]
         )
-        # two columns are named the same, this fixes that
-        nh = []
-        done_foi = False
-        for h in df.columns:
-            l = h.lower().strip().replace(".1", "")
-            if l == "personal data of the applicant":
-                if done_foi:
-                    nh.append("Personal data of the applicant - EIR")
-                else:
-                    nh.append("Personal data of the applicant - FOI")
-                    done_foi = True
-            else:
-                nh.append(h.strip())
-        df.columns = nh
-
-        done_foi = False
-        nh = []
-        for h in df.columns:
-            if h.lower().strip() == "third party personal data":
-                if done_foi:
-                    nh.append("Third party personal data - EIR")
-                else:
-                    nh.append("Third party personal data - FOI")
-                    done_foi = True
-            else:
-                nh.append(h.strip())
-        df.columns = nh
-
         return df
@@ -1,14 +1,369 @@
+import hashlib
+import json
+import multiprocessing
 import os
-from dirsync import sync
+import sqlite3
+import time
+import traceback
+from urllib.request import pathname2url
 
 from django.conf import settings
+from django.db import connections
 
+from dirsync import sync
 from django_sourdough.views import BaseBakeManager
 
+from .charts import get_spec_cache
+from .profiling import SQLProfile, capture_queries, profiling_enabled
+
+
+def bake_views():
+    """
+    the views to bake, in the order they are defined
+    """
+    from . import views
+
+    return [
+        x
+        for x in vars(views).values()
+        if isinstance(x, type)
+        and issubclass(x, views.LocalView)
+        and getattr(x, "url_name", None)
+    ]
+
+
+def collect_pages(view_classes=None, profile=None):
+    """
+    every (view, args) pair to render, as a list
+    if given an SQLProfile, the queries each view's bake_args runs are added to it
+    """
+    pages = []
+    for view_class in view_classes or bake_views():
+        view = view_class()
+        with capture_queries(profile is not None) as queries:
+            all_args = list(view.bake_args())
+        if queries:
+            profile.add_page("{0}.bake_args".format(view_class.__name__), queries)
+        pages.extend((view, args) for args in all_args)
+    return pages
+
+
+def describe_args(args):
+    if not args:
+        return ""
+    return "/".join(str(x) for x in args if isinstance(x, (str, int)))
+
+
+MANIFEST_NAME = ".bake-manifest.json"
+
+# memory map up to 1GB of the source database while copying it
+SOURCE_MMAP_SIZE = 1024**3
+# page cache for the in-memory database, in KB
+MEMORY_CACHE_KB = 256 * 1024
+
+# settings that change what is written into pages
+PAGE_SETTINGS = [
+    "SITE_ROOT",
+    "STATIC_URL",
+    "MEDIA_URL",
+    "HTML_MINIFY",
+    "IS_LIVE",
+    "EXPORT_CHARTS",
+    "CHART_DATA_FILES",
+    "CHART_DATA_URL",
+]
+
+_code_digest = None
+
+
+def code_digest():
+    """
+    mtimes of the templates and the code that renders pages,
+    and the settings that affect them
+    changing any of them re-renders everything
+    """
+    global _code_digest
+    if _code_digest is None:
+        from . import charts, cube, derived, frames, links, models, views
+
+        modules = [charts, cube, derived, frames, links, models, views]
+        files = [x.__file__ for x in modules]
+        for folder in settings.TEMPLATES[0]["DIRS"]:
+            for root, _, names in os.walk(folder):
+                files.extend(os.path.join(root, x) for x in names)
+        h = hashlib.sha1()
+        for path in sorted(files):
+            h.update("{0}={1}".format(path, os.stat(path).st_mtime_ns).encode())
+        for name in PAGE_SETTINGS:
+            h.update("{0}={1!r}".format(name, getattr(settings, name, None)).encode())
+        _code_digest = h.hexdigest()
+    return _code_digest
+
+
+def page_fingerprint(view, args):
+    """
+    digest of everything a page is made from
+    """
+    h = hashlib.sha1(code_digest().encode())
+    h.update(view.__class__.__name__.encode())
+    h.update(describe_args(args).encode())
+    for part in view.bake_inputs(*(args or ())):
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+    return h.hexdigest()
+
+
+def bake_path(view, args):
+    """
+    where a page is written, relative to the bake folder
+    """
+    path = view._get_bake_path(*(args or ()))
+    if os.path.isabs(path):
+        path = os.path.relpath(path, settings.BAKE_LOCATION)
+    return path
+
+
+class BakeManifest(object):
+    """
+    record of the fingerprint of every page in the last bake
+    """
+
+    def __init__(self, pages=None):
+        self.pages = pages or {}
+
+    @classmethod
+    def location(cls):
+        return os.path.join(settings.BAKE_LOCATION, MANIFEST_NAME)
+
+    @classmethod
+    def load(cls):
+        if not os.path.exists(cls.location()):
+            return cls()
+        with open(cls.location()) as f:
+            return cls(json.load(f))
+
+    def save(self):
+        os.makedirs(settings.BAKE_LOCATION, exist_ok=True)
+        tmp = self.location() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.pages, f, indent=0, sort_keys=True)
+        os.replace(tmp, self.location())
+
+    def is_current(self, path, fingerprint):
+        return self.pages.get(path) == fingerprint and os.path.exists(
+            os.path.join(settings.BAKE_LOCATION, path)
+        )
+
+    def remove_stale(self, seen):
+        """
+        delete pages from the last bake that weren't baked this time
+        """
+        stale = [x for x in self.pages if x not in seen]
+        for path in stale:
+            full_path = os.path.join(settings.BAKE_LOCATION, path)
+            if os.path.exists(full_path):
+                os.remove(full_path)
+            folder = os.path.dirname(full_path)
+            while folder.startswith(settings.BAKE_LOCATION + os.sep) and not os.listdir(
+                folder
+            ):
+                os.rmdir(folder)
+                folder = os.path.dirname(folder)
+            del self.pages[path]
+        return len(stale)
+
+
+def bake_pages(
+    pages, manifest, incremental=True, label="bake", profile=None, only_absent=False
+):
+    """
+    render the pages whose fingerprint has changed since the last bake
+    (or with only_absent, the pages that haven't been written at all)
+    returns the fingerprints of all pages, counts and any errors
+    if given an SQLProfile, the queries for each page are added to it
+    """
+    seen = {}
+    rendered = 0
+    skipped = 0
+    errors = []
+    for view, args in pages:
+        try:
+            path = bake_path(view, args)
+            if only_absent and os.path.exists(
+                os.path.join(settings.BAKE_LOCATION, path)
+            ):
+                # left alone - keep its old fingerprint (if any) so a
+                # later bake still re-renders it if it has changed
+                seen[path] = manifest.pages.get(path, "")
+                skipped += 1
+            else:
+                fingerprint = page_fingerprint(view, args)
+                if incremental and manifest.is_current(path, fingerprint):
+                    skipped += 1
+                else:
+                    with capture_queries(profile is not None) as queries:
+                        view.render_to_file(args)
+                    if profile is not None:
+                        profile.add_page(path, queries)
+                    rendered += 1
+                seen[path] = fingerprint
+        except Exception:
+            errors.append(
+                (view.__class__.__name__, describe_args(args), traceback.format_exc())
+            )
+        done = rendered + skipped + len(errors)
+        if done % 500 == 0:
+            print("{0}: {1} pages".format(label, done), flush=True)
+
+    specs = get_spec_cache()
+    print(
+        "{0}: {1} chart specs reused, {2} built".format(label, specs.hits, specs.misses)
+    )
+    return seen, rendered, skipped, errors
+
+
+def memory_database_loaded():
+    with connections["default"].cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'")
+        return cursor.fetchone()[0] > 0
+
+
+def load_memory_database(force=False):
+    """
+    copy the on-disk database into the in-memory default database
+    with sqlite's backup api, unless it has already been loaded
+    """
+    default = connections["default"]
+    default.ensure_connection()
+    if not force and memory_database_loaded():
+        return
+
+    start = time.perf_counter()
+    # immutable - nothing writes to the file during a bake,
+    # so sqlite can skip locking and read it through a memory map
+    path = settings.DATABASES["memory_source"]["NAME"]
+    uri = "file:{0}?mode=ro&immutable=1".format(pathname2url(os.path.abspath(path)))
+    source = sqlite3.connect(uri, uri=True)
+    try:
+        source.execute("PRAGMA mmap_size = {0}".format(SOURCE_MMAP_SIZE))
+        source.backup(default.connection)
+    finally:
+        source.close()
+    read_only_pragmas(default.connection)
+    print(
+        "loaded {0:,.1f}MB database into memory in {1:.2f}s".format(
+            os.path.getsize(path) / 1024 / 1024, time.perf_counter() - start
+        ),
+        flush=True,
+    )
+
+
+def read_only_pragmas(connection):
+    """
+    settings for a database that is only read while rendering
+    """
+    connection.execute("PRAGMA temp_store = MEMORY")
+    connection.execute("PRAGMA cache_size = -{0}".format(MEMORY_CACHE_KB))
+    if getattr(settings, "BAKE_READ_ONLY", True):
+        # fail loudly if anything tries to write while baking
+        connection.execute("PRAGMA query_only = ON")
+
+
+def use_worker_database(worker):
+    """
+    give a forked worker its own in-memory copy of the database
+    """
+    for connection in connections.all():
+        # don't close connections inherited from the parent -
+        # that would release the parent's locks on the database file
+        connection.connection = None
+    if "memory_source" not in settings.DATABASES:
+        # not baking from memory - the database file is just reopened
+        return
+    name = "file:memorydb_worker{0}?mode=memory&cache=shared".format(worker)
+    connections["default"].settings_dict["NAME"] = name
+    load_memory_database(force=True)
+
+
+# the pages for a bake across workers - set in the parent before the
+# workers fork, so each view's bake_args only runs once
+_worker_pages = []
+
+
+def bake_worker(worker, workers, manifest, incremental, only_absent=False):
+    """
+    bake every page in the list where position % workers == worker
+    """
+    use_worker_database(worker)
+    profile = SQLProfile() if profiling_enabled() else None
+    pages = _worker_pages[worker::workers]
+    label = "worker {0}".format(worker)
+    results = bake_pages(pages, manifest, incremental, label, profile, only_absent)
+    return results, profile
+
+
+def bake_in_workers(
+    workers, pages, manifest, incremental, profile=None, only_absent=False
+):
+    """
+    split the pages across worker processes
+    """
+    global _worker_pages
+    print("baking with {0} workers".format(workers))
+    _worker_pages = pages
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, maxtasksperchild=1) as pool:
+        results = pool.starmap(
+            bake_worker,
+            [(x, workers, manifest, incremental, only_absent) for x in range(workers)],
+        )
+    _worker_pages = []
+
+    seen = {}
+    rendered = 0
+    skipped = 0
+    all_errors = []
+    for worker, (worker_results, worker_profile) in enumerate(results):
+        worker_seen, worker_rendered, worker_skipped, errors = worker_results
+        print(
+            "worker {0}: {1} rendered, {2} unchanged, {3} errors".format(
+                worker, worker_rendered, worker_skipped, len(errors)
+            )
+        )
+        seen.update(worker_seen)
+        rendered += worker_rendered
+        skipped += worker_skipped
+        all_errors.extend(errors)
+        if profile is not None:
+            profile.merge(worker_profile)
+    return seen, rendered, skipped, all_errors
+
+
+def finish_bake(manifest, seen, rendered, skipped, errors):
+    """
+    report, update the manifest and remove pages that are no longer baked
+    stale pages are kept if anything failed, as the list of pages is incomplete
+    """
+    manifest.pages.update(seen)
+    if not errors:
+        removed = manifest.remove_stale(seen)
+    else:
+        removed = 0
+    manifest.save()
+
+    print(
+        "baked {0} pages, {1} unchanged, {2} removed".format(rendered, skipped, removed)
+    )
+    for view_name, args, error in errors:
+        print("error baking {0} {1}".format(view_name, args))
+        print(error)
+    if errors:
+        raise RuntimeError("{0} pages failed to bake".format(len(errors)))
+
 
 class BakeManager(BaseBakeManager):
     """
-    add support for copying media files
+    add support for copying media files,
+    only re-rendering changed pages and baking across several processes
     """
 
     def copy_media_files(self):
@@ -22,7 +377,31 @@ class BakeManager(BaseBakeManager):
         super(BakeManager, self).amend_settings(**kwargs)
         settings.IS_LIVE = True
         settings.EXPORT_CHARTS = True
+        self.workers = int(
+            kwargs.get("workers") or getattr(settings, "BAKE_WORKERS", 1)
+        )
+        self.incremental = getattr(settings, "BAKE_INCREMENTAL", True)
+        # the sourdough option - skip any page that has already been written
+        self.only_absent = bool(kwargs.get("only_absent"))
 
-    # def bake_app(self):
-    #    self.app_urls.bake(only_absent=True) #
-    #    #self.copy_media_files()
+    def bake_app(self):
+        # this replaces sourdough's loop over the views, so of its
+        # options only --only-absent is used. the list of pages is
+        # worked out here, even when baking in workers
+        load_memory_database()
+        manifest = BakeManifest.load()
+        incremental = getattr(self, "incremental", True)
+        only_absent = getattr(self, "only_absent", False)
+        profile = SQLProfile() if profiling_enabled() else None
+        pages = collect_pages(profile=profile)
+        if getattr(self, "workers", 1) > 1:
+            results = bake_in_workers(
+                self.workers, pages, manifest, incremental, profile, only_absent
+            )
+        else:
+            results = bake_pages(
+                pages, manifest, incremental, profile=profile, only_absent=only_absent
+            )
+        if profile is not None:
+            print("SQL profile written to {0}".format(profile.write()))
+        finish_bake(manifest, *results)
@@ -0,0 +1,463 @@
+"""
+Timing comparisons for the slower parts of populate and bake
+"""
+
+import itertools
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.urls import reverse
+
+import numpy as np
+import pandas as pd
+
+from . import frames, views
+from .bake import (
+    BakeManifest,
+    bake_in_workers,
+    bake_pages,
+    bake_path,
+    collect_pages,
+    describe_args,
+)
+from .links import LinkRegistry
+from .models import (
+    Authority,
+    Jurisdiction,
+)
+
+# methods that build charts and tables, timed separately by the bake benchmark
+CHART_METHODS = [
+    (views.HomeView, "get_over_time_chart"),
+    (views.HomeView, "get_all_time_chart"),
+    (views.HomeView, "get_type_distribution_chart"),
+    (views.PropertyView, "public_bodies_table"),
+    (views.PropertyView, "property_over_time"),
+    (views.YearView, "public_bodies_table"),
+    (views.YearView, "sector_distribution"),
+    (views.BodyStatisticView, "get_table"),
+    (views.BodyStatisticView, "property_over_time"),
+    (views.BodyView, "resolve_chart"),
+    (Authority, "stats_tree_tables"),
+]
+
+BAKE_VIEWS = [
+    views.OverviewView,
+    views.HomeView,
+    views.PropertyView,
+    views.YearView,
+    views.BodyStatisticView,
+    views.BodyView,
+]
+
+# metrics compared against a baseline, and whether bigger is better
+BAKE_METRICS = [
+    ("pages_per_sec", True),
+    ("p50_ms", False),
+    ("p95_ms", False),
+    ("queries_per_page", False),
+    ("query_ms_per_page", False),
+    ("chart_ms_per_page", False),
+    ("bytes_per_page", False),
+]
+
+
+def zero_if_none(v):
+    """
+    return 0 if none
+    the per value conversion load_year used before clean_numeric_block
+    """
+    if v:
+        if pd.isnull(v):
+            return 0
+        if v == "-":
+            return 0
+        if v == "--":
+            return 0
+        if isinstance(v, str):
+            v = v.strip()
+            if not v:
+                return 0
+            # if "," in v:
+            #    v = v.replace(",", "")
+            return int(v)
+        if isinstance(v, int):
+            return v
+        if isinstance(v, float):
+            return int(v)
+        else:
+            return 0
+    else:
+        return 0
+
+
+def legacy_authority_values(df, authority_lookup, properties, adapter):
+    """
+    the row by row construction load_year used to do
+    kept to check the vectorised path gives the same rows
+    """
+    rows = []
+    for index, r in df.iterrows():
+        if pd.isnull(r[adapter.overall_total_column]):
+            continue
+        authority_id = authority_lookup.get(r[adapter.authority_name_column], None)
+        if authority_id:
+            for property_id, name in properties:
+                rows.append((authority_id, property_id, zero_if_none(r[name])))
+    return rows
+
+
+def benchmark_load_year(slug="foisa"):
+    """
+    compare building Value rows with iterrows against the vectorised path
+    on the shipped resources for a jurisdiction
+    """
+    jurisdiction = Jurisdiction.objects.get(slug=slug)
+    adapter = jurisdiction.adapter()
+    authority_lookup = {x.name: x.id for x in jurisdiction.authorities.all()}
+    properties = [
+        (x.id, x.name)
+        for x in jurisdiction.properties.filter(dynamic=None).order_by("id")
+    ]
+
+    legacy_total = 0.0
+    vector_total = 0.0
+    for year in jurisdiction.years.order_by("number"):
+        df = adapter.get_year(year.number, authority_lookup)
+
+        start = time.perf_counter()
+        legacy = legacy_authority_values(df, authority_lookup, properties, adapter)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vector = frames.authority_values(
+            df,
+            authority_lookup,
+            properties,
+            adapter.authority_name_column,
+            adapter.overall_total_column,
+        )
+        vector_time = time.perf_counter() - start
+
+        vector_rows = list(
+            zip(
+                vector["authority_id"].tolist(),
+                vector["property_id"].tolist(),
+                vector["value"].tolist(),
+            )
+        )
+        if vector_rows != [(a, p, float(v)) for a, p, v in legacy]:
+            raise ValueError("Vectorised rows differ for {0}".format(year.slug))
+
+        legacy_total += legacy_time
+        vector_total += vector_time
+        print(
+            "{year}: {rows:,} rows, iterrows {legacy:.3f}s, vectorised {vector:.3f}s".format(
+                year=year.slug,
+                rows=len(vector_rows),
+                legacy=legacy_time,
+                vector=vector_time,
+            )
+        )
+
+    print(
+        "total: iterrows {legacy:.3f}s, vectorised {vector:.3f}s ({ratio:.1f}x)".format(
+            legacy=legacy_total,
+            vector=vector_total,
+            ratio=legacy_total / vector_total if vector_total else 0,
+        )
+    )
+
+
+class QueryTimer(object):
+    """
+    database execute wrapper counting and timing queries
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - start
+
+
+class ChartTimer(object):
+    """
+    time spent in the methods that build charts and tables
+    (only the outermost call is counted when they call each other)
+    """
+
+    def __init__(self):
+        self.time = 0.0
+        self.depth = 0
+
+    def wrap(self, method):
+        def timed(*args, **kwargs):
+            self.depth += 1
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.time += time.perf_counter() - start
+
+        return timed
+
+    @contextmanager
+    def installed(self):
+        originals = [(cls, name, cls.__dict__[name]) for cls, name in CHART_METHODS]
+        for cls, name, method in originals:
+            setattr(cls, name, self.wrap(method))
+        try:
+            yield self
+        finally:
+            for cls, name, method in originals:
+                setattr(cls, name, method)
+
+
+def bake_sample(view_class, sample):
+    """
+    the first 'sample' pages of a view
+    """
+    view = view_class()
+    return [(view, args) for args in itertools.islice(view.bake_args(), sample)]
+
+
+def benchmark_view(view_class, sample):
+    """
+    render a sample of a view's pages, recording time, queries and size
+    """
+    pages = bake_sample(view_class, sample)
+    render_times = []
+    queries = QueryTimer()
+    charts = ChartTimer()
+    output_bytes = 0
+
+    with connection.execute_wrapper(queries), charts.installed():
+        for view, args in pages:
+            start = time.perf_counter()
+            view.render_to_file(args)
+            render_times.append(time.perf_counter() - start)
+            path = os.path.join(settings.BAKE_LOCATION, bake_path(view, args))
+            output_bytes += os.path.getsize(path)
+            print(
+                "{0} {1}: {2:.3f}s".format(
+                    view_class.__name__, describe_args(args), render_times[-1]
+                )
+            )
+
+    n = len(pages)
+    if n == 0:
+        return {"pages": 0}
+    total = sum(render_times)
+    return {
+        "pages": n,
+        "seconds": total,
+        "pages_per_sec": n / total if total else 0,
+        "p50_ms": float(np.percentile(render_times, 50)) * 1000,
+        "p95_ms": float(np.percentile(render_times, 95)) * 1000,
+        "queries": queries.count,
+        "queries_per_page": queries.count / n,
+        "query_ms_per_page": queries.time * 1000 / n,
+        "chart_ms_per_page": charts.time * 1000 / n,
+        "bytes_per_page": output_bytes / n,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    print the change in each metric from the baseline
+    returns the list of (view, metric) that got worse by more than tolerance
+    """
+    regressions = []
+    for view_name, metrics in results["views"].items():
+        before = baseline["views"].get(view_name)
+        if not before or not metrics.get("pages") or not before.get("pages"):
+            continue
+        for metric, bigger_is_better in BAKE_METRICS:
+            old = before.get(metric)
+            new = metrics[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if bigger_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = " REGRESSION"
+                regressions.append((view_name, metric))
+            print(
+                "{view} {metric}: {old:,.2f} -> {new:,.2f} ({change:+.0%}){flag}".format(
+                    view=view_name,
+                    metric=metric,
+                    old=old,
+                    new=new,
+                    change=change,
+                    flag=flag,
+                )
+            )
+    return regressions
+
+
+def benchmark_bake(
+    sample=20, output="bake_benchmark.json", baseline=None, tolerance=0.2, only=None
+):
+    """
+    bake a sample of each view's pages into a temporary folder
+    and write per view timings to a json file
+    returns any regressions against the baseline
+    """
+    view_classes = [x for x in BAKE_VIEWS if not only or x.__name__ in only]
+    results = {"sample": sample, "views": {}}
+
+    # render as the bake does, but without exporting chart images
+    settings.IS_LIVE = True
+    original_location = settings.BAKE_LOCATION
+    with tempfile.TemporaryDirectory() as folder:
+        settings.BAKE_LOCATION = folder
+        try:
+            for view_class in view_classes:
+                results["views"][view_class.__name__] = benchmark_view(
+                    view_class, sample
+                )
+        finally:
+            settings.BAKE_LOCATION = original_location
+
+    for view_name, metrics in results["views"].items():
+        if not metrics["pages"]:
+            print("{0}: no pages".format(view_name))
+            continue
+        print(
+            "{view}: {pages} pages, {pages_per_sec:.1f} pages/s, "
+            "p50 {p50_ms:.0f}ms, p95 {p95_ms:.0f}ms, "
+            "{queries_per_page:.1f} queries/page ({query_ms_per_page:.1f}ms), "
+            "charts {chart_ms_per_page:.1f}ms/page, "
+            "{bytes_per_page:,.0f} bytes/page".format(view=view_name, **metrics)
+        )
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4)
+    print("written to {0}".format(output))
+
+    if baseline:
+        with open(baseline) as f:
+            return compare_to_baseline(results, json.load(f), tolerance)
+    return []
+
+
+def read_tree(folder):
+    """
+    contents of every file under a folder, by relative path
+    """
+    files = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, folder)] = f.read()
+    return files
+
+
+def benchmark_workers(workers=2, only=None):
+    """
+    bake the pages of each view serially and across workers
+    into two temporary folders and check the output is byte for byte the same
+    returns the paths that differ
+    """
+    view_classes = [x for x in BAKE_VIEWS if not only or x.__name__ in only]
+    settings.IS_LIVE = True
+    original_location = settings.BAKE_LOCATION
+    trees = []
+    try:
+        start = time.perf_counter()
+        pages = collect_pages(view_classes)
+        print(
+            "{0:,} pages listed in {1:.2f}s".format(
+                len(pages), time.perf_counter() - start
+            )
+        )
+        for n in [1, workers]:
+            with tempfile.TemporaryDirectory() as folder:
+                settings.BAKE_LOCATION = folder
+                start = time.perf_counter()
+                if n == 1:
+                    results = bake_pages(pages, BakeManifest(), incremental=False)
+                else:
+                    results = bake_in_workers(n, pages, BakeManifest(), False)
+                print(
+                    "{0} worker(s): {1:,} pages in {2:.2f}s, {3} errors".format(
+                        n, results[1], time.perf_counter() - start, len(results[3])
+                    )
+                )
+                trees.append(read_tree(folder))
+    finally:
+        settings.BAKE_LOCATION = original_location
+
+    serial, parallel = trees
+    differ = sorted(
+        x for x in set(serial) | set(parallel) if serial.get(x) != parallel.get(x)
+    )
+    for path in differ:
+        print("differs: {0}".format(path))
+    if not differ:
+        print("{0:,} files identical".format(len(serial)))
+    return differ
+
+
+def benchmark_links(slug="foisa"):
+    """
+    compare reverse() against the link registry for every link
+    the tables of a jurisdiction's pages make
+    """
+    jurisdiction = Jurisdiction.objects.get(slug=slug)
+    cube = jurisdiction.cube()
+
+    start = time.perf_counter()
+    registry = LinkRegistry(cube, slug)
+    build_time = time.perf_counter() - start
+
+    keys = list(registry.paths.keys())
+
+    start = time.perf_counter()
+    reversed_paths = [reverse(url_name, args=args) for url_name, args in keys]
+    reverse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    registry_paths = [registry.path(url_name, *args) for url_name, args in keys]
+    lookup_time = time.perf_counter() - start
+
+    if reversed_paths != registry_paths:
+        raise ValueError("Link registry paths differ from reverse()")
+
+    print(
+        "{links:,} links: reverse {reverse:.3f}s, "
+        "registry build {build:.3f}s + lookups {lookup:.3f}s".format(
+            links=len(keys), reverse=reverse_time, build=build_time, lookup=lookup_time
+        )
+    )
+    # reverse() calls the tables on one page of each type used to make
+    authorities = len(registry.authorities)
+    per_page = {
+        "PropertyView": authorities + len(registry.render_full),
+        "YearView": authorities,
+        "BodyView": len(cube.property_ids) * 2,
+        "BodyStatisticView": len(cube.year_numbers),
+    }
+    per_link = reverse_time / len(keys) if keys else 0
+    for view_name, n in per_page.items():
+        print(
+            "{0}: ~{1:,} links a page, {2:.1f}ms of reverse() saved a page".format(
+                view_name, n, n * per_link * 1000
+            )
+        )
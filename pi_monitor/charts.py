@@ -0,0 +1,201 @@
+"""
+Altair charts whose Vega-Lite specs are cached by content
+
+The same sector and overall charts appear on many pages and change only
+when the data does. Specs are stored under a hash of the chart's data
+and options and of the code that renders them, in memory and in
+CHART_SPEC_CACHE on disk, so each distinct chart is serialised once and
+later bakes reuse the specs for unchanged data.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from collections import OrderedDict
+
+from django.conf import settings
+
+import altair as alt
+import pandas as pd
+from research_common.charts import AltairChart as BaseAltairChart
+
+MEMORY_SPECS = 500
+
+
+def code_version():
+    """
+    the code that turns a chart into a spec:
+    this module, the research_common chart class and altair
+    """
+    h = hashlib.sha1(alt.__version__.encode("utf-8"))
+    for module in (__name__, BaseAltairChart.__module__):
+        with open(sys.modules[module].__file__, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+_code_version = None
+
+
+def get_code_version():
+    global _code_version
+    if _code_version is None:
+        _code_version = code_version()
+    return _code_version
+
+
+def hash_value(h, value):
+    """
+    add something a chart is made from to a hash
+    """
+    if isinstance(value, pd.DataFrame):
+        h.update(repr(list(value.columns)).encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, dict):
+        for k in sorted(value, key=str):
+            h.update(repr(k).encode("utf-8"))
+            hash_value(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        for x in value:
+            hash_value(h, x)
+    elif callable(value):
+        # functions repr with their address, which changes every run
+        code = getattr(value, "__code__", None)
+        h.update(getattr(value, "__qualname__", type(value).__name__).encode("utf-8"))
+        if code is not None:
+            h.update(code.co_code)
+            h.update(repr(code.co_consts).encode("utf-8"))
+    else:
+        h.update(repr(value).encode("utf-8"))
+
+
+class SpecCache(object):
+    """
+    serialised specs by content hash, in memory and on disk
+    """
+
+    def __init__(self, folder=None, size=MEMORY_SPECS):
+        self.folder = folder
+        self.size = size
+        self.specs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".json")
+
+    def get(self, key, disk=True):
+        if key in self.specs:
+            self.specs.move_to_end(key)
+            return self.specs[key]
+        if disk and self.folder and os.path.exists(self.path(key)):
+            with open(self.path(key), encoding="utf-8") as f:
+                spec = f.read()
+            self.remember(key, spec)
+            return spec
+        return None
+
+    def remember(self, key, spec):
+        self.specs[key] = spec
+        while len(self.specs) > self.size:
+            self.specs.popitem(last=False)
+
+    def set(self, key, spec, disk=True):
+        self.remember(key, spec)
+        if disk and self.folder:
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(spec)
+            os.replace(tmp, path)
+
+    def get_or_build(self, key, build):
+        spec = self.get(key)
+        if spec is not None:
+            self.hits += 1
+            return spec
+        self.misses += 1
+        spec = build()
+        if isinstance(spec, str):
+            self.set(key, spec)
+        return spec
+
+
+_spec_cache = None
+
+
+def get_spec_cache():
+    global _spec_cache
+    if _spec_cache is None:
+        _spec_cache = SpecCache(getattr(settings, "CHART_SPEC_CACHE", None))
+    return _spec_cache
+
+
+def use_data_files(spec):
+    """
+    move the datasets in a spec to json files named by their contents
+    and point the spec at them, so each dataset is stored once for the site
+    """
+    if not isinstance(spec, str):
+        return spec
+    spec = json.loads(spec)
+    datasets = spec.pop("datasets", None)
+    if not datasets:
+        return json.dumps(spec)
+
+    urls = {}
+    for name, rows in datasets.items():
+        content = json.dumps(rows, separators=(",", ":"))
+        filename = hashlib.sha1(content.encode("utf-8")).hexdigest() + ".json"
+        path = os.path.join(settings.CHART_DATA_LOCATION, filename)
+        if not os.path.exists(path):
+            os.makedirs(settings.CHART_DATA_LOCATION, exist_ok=True)
+            tmp = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp, path)
+        urls[name] = settings.CHART_DATA_URL + filename
+
+    def replace(item):
+        if isinstance(item, dict):
+            data = item.get("data")
+            if isinstance(data, dict) and data.get("name") in urls:
+                item["data"] = {"url": urls[data["name"]]}
+            for value in item.values():
+                replace(value)
+        elif isinstance(item, list):
+            for value in item:
+                replace(value)
+
+    replace(spec)
+    return json.dumps(spec)
+
+
+class AltairChart(BaseAltairChart):
+    """
+    serialises through the spec cache
+    with CHART_DATA_FILES, the data is written to separate files
+    """
+
+    def spec_key(self):
+        h = hashlib.sha1(get_code_version().encode("utf-8"))
+        h.update(self.__class__.__name__.encode("utf-8"))
+        hash_value(h, vars(self))
+        return h.hexdigest()
+
+    def json(self):
+        cache = get_spec_cache()
+        key = self.spec_key()
+        if not getattr(settings, "CHART_DATA_FILES", False):
+            return cache.get_or_build(key, super().json)
+        # the disk cache holds the inline spec, so the data files can be
+        # rewritten from it - the media folder may have been cleared since.
+        # the url version is only remembered for this process.
+        files_key = key + "-files"
+        spec = cache.get(files_key, disk=False)
+        if spec is None:
+            spec = use_data_files(cache.get_or_build(key, super().json))
+            cache.set(files_key, spec, disk=False)
+        return spec
@@ -0,0 +1,370 @@
+"""
+Dense authority x property x year arrays of a jurisdiction's values
+
+Populate writes one of these per jurisdiction as memory-mapped .npy files
+next to the database, and the views slice it rather than querying Value.
+Cells without a Value are NaN.
+"""
+
+import hashlib
+import os
+import shutil
+
+from django.conf import settings
+
+import numpy as np
+import pandas as pd
+
+# cubes already loaded in this process, by jurisdiction slug
+_loaded = {}
+
+# header fields that can be asked for, in the style of query_to_df
+DIRECT_FIELDS = {
+    "authority_id": "authority_id",
+    "property_id": "property_id",
+    "year__number": "year",
+    "value": "value",
+    "percentage_value": "percentage_value",
+}
+
+AUTHORITY_FIELDS = {
+    "authority__name": "name",
+    "authority__slug": "slug",
+    "authority__sector_id": "sector_id",
+    "authority__sector__name": "sector__name",
+    "authority__sector__slug": "sector__slug",
+}
+
+PROPERTY_FIELDS = {
+    "property__name": "name",
+    "property__slug": "slug",
+    "property__special": "special",
+    "property__child_of_id": "child_of_id",
+}
+
+
+def year_number(slug):
+    """
+    the number of the year with a slug ("alltime" is 9999)
+    """
+    return 9999 if slug == "alltime" else int(slug)
+
+
+def year_slug(number):
+    return "alltime" if number == 9999 else str(number)
+
+
+def cube_folder(slug):
+    return os.path.join(settings.CUBE_LOCATION, slug)
+
+
+def remove_cube(slug):
+    folder = cube_folder(slug)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    _loaded.pop(slug, None)
+
+
+class ValueCube(object):
+    """
+    values and percentages for a jurisdiction indexed by authority,
+    property and year
+    """
+
+    def __init__(
+        self,
+        authority_ids,
+        property_ids,
+        year_numbers,
+        values,
+        percentages,
+        fingerprint="",
+    ):
+        self.authority_ids = np.asarray(authority_ids, dtype=np.int64)
+        self.property_ids = np.asarray(property_ids, dtype=np.int64)
+        self.year_numbers = np.asarray(year_numbers, dtype=np.int64)
+        self.authority_index = {x: i for i, x in enumerate(self.authority_ids.tolist())}
+        self.property_index = {x: i for i, x in enumerate(self.property_ids.tolist())}
+        self.year_index = {x: i for i, x in enumerate(self.year_numbers.tolist())}
+        self.values = values
+        self.percentages = percentages
+        self.fingerprint = fingerprint
+        self.authorities = None
+        self.properties = None
+        self._labels_digest = None
+
+    @classmethod
+    def fingerprint_for(cls, jurisdiction):
+        """
+        changes whenever any of the jurisdiction's years are rebuilt
+        """
+        years = jurisdiction.years.order_by("number").values_list(
+            "number", "input_digest"
+        )
+        years = ",".join("{0}={1}".format(*x) for x in years)
+        return "{0}|{1}".format(jurisdiction.id, years)
+
+    @classmethod
+    def from_database(cls, jurisdiction):
+        from .models import Value
+
+        authority_ids = sorted(jurisdiction.authorities.values_list("id", flat=True))
+        property_ids = sorted(jurisdiction.properties.values_list("id", flat=True))
+        year_numbers = sorted(jurisdiction.years.values_list("number", flat=True))
+
+        rows = Value.objects.filter(jurisdiction=jurisdiction).values_list(
+            "authority_id", "property_id", "year_number", "value", "percentage_value"
+        )
+        df = pd.DataFrame.from_records(
+            list(rows),
+            columns=[
+                "authority_id",
+                "property_id",
+                "year",
+                "value",
+                "percentage_value",
+            ],
+        )
+
+        shape = (len(authority_ids), len(property_ids), len(year_numbers))
+        values = np.full(shape, np.nan)
+        percentages = np.full(shape, np.nan)
+        if len(df):
+            a = np.searchsorted(authority_ids, df["authority_id"].to_numpy())
+            p = np.searchsorted(property_ids, df["property_id"].to_numpy())
+            y = np.searchsorted(year_numbers, df["year"].to_numpy())
+            values[a, p, y] = df["value"].to_numpy(dtype=float)
+            percentages[a, p, y] = df["percentage_value"].to_numpy(dtype=float)
+
+        return cls(
+            authority_ids,
+            property_ids,
+            year_numbers,
+            values,
+            percentages,
+            fingerprint=cls.fingerprint_for(jurisdiction),
+        )
+
+    def save(self, folder):
+        """
+        write the arrays, replacing any existing files
+        the index is written last, so a half written cube is never loaded
+        """
+        os.makedirs(folder, exist_ok=True)
+        for name, array in [("values", self.values), ("percentages", self.percentages)]:
+            path = os.path.join(folder, name + ".npy")
+            np.save(path + ".tmp.npy", np.asarray(array))
+            os.replace(path + ".tmp.npy", path)
+        path = os.path.join(folder, "index.npz")
+        np.savez(
+            path + ".tmp.npz",
+            authority_ids=self.authority_ids,
+            property_ids=self.property_ids,
+            year_numbers=self.year_numbers,
+            fingerprint=np.array(self.fingerprint),
+        )
+        os.replace(path + ".tmp.npz", path)
+
+    @classmethod
+    def load(cls, folder):
+        """
+        open a saved cube, memory mapping the arrays
+        returns None if there isn't one
+        """
+        path = os.path.join(folder, "index.npz")
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as index:
+            return cls(
+                index["authority_ids"],
+                index["property_ids"],
+                index["year_numbers"],
+                np.load(os.path.join(folder, "values.npy"), mmap_mode="r"),
+                np.load(os.path.join(folder, "percentages.npy"), mmap_mode="r"),
+                fingerprint=str(index["fingerprint"]),
+            )
+
+    @classmethod
+    def for_jurisdiction(cls, jurisdiction):
+        """
+        the current cube for a jurisdiction - from memory, disk or
+        (if what's on disk is out of date) the database
+        """
+        cube = _loaded.get(jurisdiction.slug)
+        # nothing writes to the database during a bake, so the
+        # first cube a bake process loads stays current
+        if cube and getattr(settings, "BAKE_READ_ONLY", False):
+            return cube
+        fingerprint = cls.fingerprint_for(jurisdiction)
+        if cube and cube.fingerprint == fingerprint:
+            return cube
+        cube = cls.load(cube_folder(jurisdiction.slug))
+        if cube is None or cube.fingerprint != fingerprint:
+            cube = cls.from_database(jurisdiction)
+        cube.attach_labels(jurisdiction)
+        _loaded[jurisdiction.slug] = cube
+        return cube
+
+    def attach_labels(self, jurisdiction):
+        """
+        names and slugs to go with the ids
+        """
+        authorities = jurisdiction.authorities.values(
+            "id",
+            "name",
+            "slug",
+            "sector_id",
+            "sector__name",
+            "sector__slug",
+            "is_sector",
+            "is_overall",
+            "render_full",
+        )
+        self.authorities = pd.DataFrame.from_records(list(authorities), index="id")
+        properties = jurisdiction.properties.values(
+            "id", "name", "slug", "special", "child_of_id"
+        )
+        self.properties = pd.DataFrame.from_records(list(properties), index="id")
+        self._labels_digest = None
+
+    def sector_ids(self):
+        return self.authorities.index[self.authorities["is_sector"]].tolist()
+
+    def body_ids(self):
+        a = self.authorities
+        return a.index[~a["is_sector"] & ~a["is_overall"]].tolist()
+
+    def overall_id(self):
+        return self.authorities.index[self.authorities["is_overall"]].tolist()[0]
+
+    def special_ids(self, *specials):
+        return self.properties.index[self.properties["special"].isin(specials)].tolist()
+
+    def _positions(self, index, keys):
+        if keys is None:
+            return np.arange(len(index))
+        return np.array([index[x] for x in keys if x in index], dtype=np.int64)
+
+    def frame(self, authorities=None, properties=None, years=None, exclude_years=None):
+        """
+        long frame of the values present in a slice of the cube
+        authorities and properties are lists of ids, years of year numbers
+        """
+        a_pos = self._positions(self.authority_index, authorities)
+        p_pos = self._positions(self.property_index, properties)
+        y_pos = self._positions(self.year_index, years)
+        if exclude_years:
+            keep = ~np.isin(self.year_numbers[y_pos], exclude_years)
+            y_pos = y_pos[keep]
+
+        selection = np.ix_(a_pos, p_pos, y_pos)
+        values = np.asarray(self.values[selection])
+        percentages = np.asarray(self.percentages[selection])
+        a, p, y = np.nonzero(~np.isnan(values))
+
+        return pd.DataFrame(
+            {
+                "authority_id": self.authority_ids[a_pos][a],
+                "property_id": self.property_ids[p_pos][p],
+                "year": self.year_numbers[y_pos][y],
+                "value": values[a, p, y],
+                "percentage_value": percentages[a, p, y],
+            }
+        )
+
+    def selection(self, authorities=None, properties=None, years=None):
+        return np.ix_(
+            self._positions(self.authority_index, authorities),
+            self._positions(self.property_index, properties),
+            self._positions(self.year_index, years),
+        )
+
+    def digest(self, authorities=None, properties=None, years=None):
+        """
+        hash of the values and percentages in a slice of the cube
+        """
+        selection = self.selection(authorities, properties, years)
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(self.values[selection]).tobytes())
+        h.update(np.ascontiguousarray(self.percentages[selection]).tobytes())
+        return h.hexdigest()
+
+    def labels_digest(self):
+        """
+        hash of the names, slugs and years that pages are labelled with
+        """
+        if self._labels_digest is None:
+            h = hashlib.sha1()
+            h.update(self.year_numbers.tobytes())
+            for df in [self.authorities, self.properties]:
+                h.update(df.to_csv().encode("utf-8"))
+            self._labels_digest = h.hexdigest()
+        return self._labels_digest
+
+    def authority_id(self, slug):
+        return self.authorities.index[self.authorities["slug"] == slug].tolist()[0]
+
+    def property_id(self, slug):
+        return self.properties.index[self.properties["slug"] == slug].tolist()[0]
+
+    def years_present(self, authorities=None, properties=None):
+        """
+        year numbers with at least one value in the slice
+        """
+        df = self.frame(authorities=authorities, properties=properties)
+        return sorted(df["year"].unique().tolist())
+
+    def authorities_present(self, year):
+        """
+        ids of authorities with at least one value in a year
+        """
+        values = np.asarray(self.values[:, :, self.year_index[year]])
+        return self.authority_ids[~np.isnan(values).all(axis=1)].tolist()
+
+    def field_values(self, df, field):
+        if field in DIRECT_FIELDS:
+            return df[DIRECT_FIELDS[field]]
+        if field in AUTHORITY_FIELDS:
+            column = self.authorities[AUTHORITY_FIELDS[field]]
+            return df["authority_id"].map(column)
+        if field in PROPERTY_FIELDS:
+            column = self.properties[PROPERTY_FIELDS[field]]
+            return df["property_id"].map(column)
+        raise ValueError("Unknown cube field: {0}".format(field))
+
+    def query(self, header, order_by=(), **slices):
+        """
+        DataFrame of a slice, with columns labelled as in a
+        chart or table header ({"authority__name": "Sector", ...})
+        order_by takes field names, prefixed with - for descending
+        """
+        df = self.frame(**slices)
+        sort_fields = [x.lstrip("-") for x in order_by]
+        columns = pd.DataFrame(
+            {x: self.field_values(df, x) for x in list(header.keys()) + sort_fields}
+        )
+        if sort_fields:
+            ascending = [not x.startswith("-") for x in order_by]
+            columns = columns.sort_values(
+                sort_fields, ascending=ascending, kind="stable"
+            )
+        columns = columns[list(header.keys())].rename(columns=header)
+        return columns.reset_index(drop=True)
+
+    def special_values(self, authority_id, year):
+        """
+        unsaved Values for an authority and year, keyed by property special
+        """
+        from .models import Value
+
+        df = self.frame(authorities=[authority_id], years=[year])
+        df["special"] = self.field_values(df, "property__special")
+        return {
+            r.special: Value(
+                authority_id=authority_id,
+                property_id=r.property_id,
+                value=r.value,
+                percentage_value=r.percentage_value,
+            )
+            for r in df.itertuples()
+        }
@@ -0,0 +1,230 @@
+"""
+Properties calculated from other properties
+
+The combo_of column of column_lookup.csv is either *children*
+(sum of the property's children) or an arithmetic expression over the
+slugs of other properties, e.g.
+
+    20_day_deadline_met + permitted_extension_to_20_day_deadline
+
+Definitions are compiled once per jurisdiction into a dependency ordered
+list of expression trees (plain tuples, so they can be sent to worker
+processes) and evaluated as array operations across every authority.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+CHILDREN = "*children*"
+
+TOKEN_RE = re.compile(r"\s*(?:(\d+(?:\.\d+)?)(?![a-z0-9_])|([a-z0-9_]+)|(\S))")
+
+
+def tokenize(expression):
+    tokens = []
+    for number, slug, op in TOKEN_RE.findall(expression.strip().lower()):
+        if number:
+            tokens.append(("num", float(number)))
+        elif slug:
+            tokens.append(("slug", slug))
+        else:
+            if op not in "+-*/()":
+                raise ValueError(
+                    "Unexpected '{0}' in derived property '{1}'".format(op, expression)
+                )
+            tokens.append(("op", op))
+    return tokens
+
+
+class ExpressionParser(object):
+    """
+    recursive descent parser for + - * / and brackets
+    returns nested tuples: ("num", x), ("prop", id), (op, left, right), ("neg", x)
+    """
+
+    def __init__(self, expression, slug_to_id):
+        self.expression = expression
+        self.slug_to_id = slug_to_id
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def error(self, message):
+        return ValueError(
+            "{0} in derived property '{1}'".format(message, self.expression)
+        )
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        tree = self.expr()
+        if self.position != len(self.tokens):
+            raise self.error("Unexpected '{0}'".format(self.peek()[1]))
+        return tree
+
+    def expr(self):
+        tree = self.term()
+        while self.peek() in [("op", "+"), ("op", "-")]:
+            op = self.take()[1]
+            tree = (op, tree, self.term())
+        return tree
+
+    def term(self):
+        tree = self.factor()
+        while self.peek() in [("op", "*"), ("op", "/")]:
+            op = self.take()[1]
+            tree = (op, tree, self.factor())
+        return tree
+
+    def factor(self):
+        kind, value = self.take()
+        if (kind, value) == ("op", "-"):
+            return ("neg", self.factor())
+        if (kind, value) == ("op", "("):
+            tree = self.expr()
+            if self.take() != ("op", ")"):
+                raise self.error("Missing ')'")
+            return tree
+        if kind == "num":
+            return ("num", value)
+        if kind == "slug":
+            if value not in self.slug_to_id:
+                raise self.error("Unknown property '{0}'".format(value))
+            return ("prop", self.slug_to_id[value])
+        raise self.error("Unexpected end of expression")
+
+
+def tree_dependencies(tree):
+    if tree[0] == "prop":
+        return {tree[1]}
+    if tree[0] == "num":
+        return set()
+    if tree[0] == "sum":
+        return set(tree[1])
+    return set().union(*[tree_dependencies(x) for x in tree[1:]])
+
+
+class DerivedProperties(object):
+    """
+    compiled set of derived properties for a jurisdiction
+    """
+
+    def __init__(self, properties):
+        """
+        properties is a list of (property_id, slug, combo_of, child_ids)
+        for every property in the jurisdiction
+        """
+        slug_to_id = {slug: property_id for property_id, slug, _, _ in properties}
+
+        trees = {}
+        self.property_ids = []
+        for property_id, slug, combo_of, child_ids in properties:
+            if not combo_of:
+                continue
+            if combo_of == CHILDREN:
+                trees[property_id] = ("sum", tuple(child_ids))
+            else:
+                trees[property_id] = ExpressionParser(combo_of, slug_to_id).parse()
+            self.property_ids.append(property_id)
+
+        self.order = self.resolve_order(trees)
+        self.trees = trees
+
+    @classmethod
+    def resolve_order(cls, trees):
+        """
+        order derived properties so each comes after any it depends on
+        """
+        order = []
+        done = set()
+        visiting = set()
+
+        def visit(property_id):
+            if property_id in done:
+                return
+            if property_id in visiting:
+                raise ValueError(
+                    "Derived property {0} depends on itself".format(property_id)
+                )
+            visiting.add(property_id)
+            for d in sorted(tree_dependencies(trees[property_id])):
+                if d in trees:
+                    visit(d)
+            visiting.remove(property_id)
+            done.add(property_id)
+            order.append(property_id)
+
+        for property_id in trees:
+            visit(property_id)
+        return order
+
+    def __len__(self):
+        return len(self.property_ids)
+
+    def evaluate_tree(self, tree, columns, n_rows):
+        kind = tree[0]
+        if kind == "num":
+            return np.full(n_rows, tree[1])
+        if kind == "prop":
+            return columns.get(tree[1], np.zeros(n_rows))
+        if kind == "sum":
+            total = np.zeros(n_rows)
+            for c in tree[1]:
+                if c in columns:
+                    total = total + columns[c]
+            return total
+        if kind == "neg":
+            return -self.evaluate_tree(tree[1], columns, n_rows)
+        left = self.evaluate_tree(tree[1], columns, n_rows)
+        right = self.evaluate_tree(tree[2], columns, n_rows)
+        if kind == "+":
+            return left + right
+        if kind == "-":
+            return left - right
+        if kind == "*":
+            return left * right
+        result = np.zeros(n_rows)
+        np.divide(left, right, out=result, where=right != 0)
+        return result
+
+    def evaluate(self, values):
+        """
+        values is a long frame of authority_id, property_id, value
+        returns the derived values for every authority in the same shape
+        """
+        values = values.drop_duplicates(["authority_id", "property_id"], keep="last")
+        wide = values.pivot(index="authority_id", columns="property_id", values="value")
+        wide = wide.sort_index()
+        # inputs are whole numbers, missing values count as 0
+        matrix = np.trunc(wide.fillna(0).to_numpy(dtype=float))
+        columns = {p: matrix[:, i] for i, p in enumerate(wide.columns)}
+
+        n_rows = len(wide.index)
+        for property_id in self.order:
+            columns[property_id] = self.evaluate_tree(
+                self.trees[property_id], columns, n_rows
+            )
+
+        derived = np.column_stack(
+            [columns[x] for x in self.property_ids] or [np.zeros((n_rows, 0))]
+        )
+        return pd.DataFrame(
+            {
+                "authority_id": np.repeat(
+                    wide.index.to_numpy(dtype=np.int64), len(self.property_ids)
+                ),
+                "property_id": np.tile(
+                    np.asarray(self.property_ids, dtype=np.int64), n_rows
+                ),
+                "value": derived.ravel(),
+            }
+        )
@@ -0,0 +1,155 @@
+"""
+Vectorised helpers to turn the DataFrame an adapter returns for a year
+into long rows of (authority_id, property_id, value, percentage_value)
+ready to be written as Values
+"""
+
+import importlib
+
+import numpy as np
+import pandas as pd
+
+from .adapters import AdapterRegistry
+from .adapters.base import clean_numeric_block
+
+
+def numeric_block(df, columns):
+    """
+    coerce a block of columns to numbers in one pass
+    anything that can't be read as a number ("-", blanks) becomes NaN
+    """
+    return clean_numeric_block(df, columns)[0]
+
+
+def value_frame(authority_ids, property_ids, matrix):
+    """
+    melt an authority x property matrix into long rows
+    (authority major, to match the order rows used to be queued in)
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    n_rows, n_props = matrix.shape
+    return pd.DataFrame(
+        {
+            "authority_id": np.repeat(
+                np.asarray(authority_ids, dtype=np.int64), n_props
+            ),
+            "property_id": np.tile(np.asarray(property_ids, dtype=np.int64), n_rows),
+            "value": matrix.ravel(),
+        }
+    )
+
+
+def authority_values(df, authority_lookup, properties, name_column, total_column):
+    """
+    values for each authority row in df
+    properties is a list of (property_id, column name) pairs
+    rows without a total or that don't match a known authority are skipped
+    """
+    authority_ids = df[name_column].map(authority_lookup)
+    keep = df[total_column].notnull() & authority_ids.notnull()
+
+    property_ids = [x[0] for x in properties]
+    columns = [x[1] for x in properties]
+
+    block = numeric_block(df.loc[keep], columns)
+    # stored values are whole numbers (truncated, as int() would)
+    matrix = np.trunc(block.fillna(0).to_numpy(dtype=float))
+
+    return value_frame(authority_ids[keep], property_ids, matrix)
+
+
+def rollup_values(df, context, name_column):
+    """
+    totals for every level above the authorities, in one pass
+
+    each row is added to every sector above its authority (following the
+    sector chain from authorities.csv) and to the overall authority.
+    """
+    normal_properties = context["normal_properties"]
+    block = numeric_block(df, [x[1] for x in normal_properties])
+    block = block.fillna(0).to_numpy(dtype=float)
+    positions = np.arange(len(df))
+
+    # (row, group) pairs - every row counts towards the overall authority
+    ancestors = df[name_column].map(context["ancestors"])
+    ancestors = pd.Series(
+        [x if isinstance(x, list) else [] for x in ancestors], index=positions
+    ).explode()
+    ancestors = ancestors[ancestors.notnull()]
+    rows = [ancestors.index.to_numpy(dtype=np.int64), positions]
+    groups = [
+        ancestors.to_numpy(dtype=np.int64),
+        np.full(len(df), context["overall_id"], dtype=np.int64),
+    ]
+
+    pairs = pd.DataFrame({"row": np.concatenate(rows), "group": np.concatenate(groups)})
+    pairs = pairs.drop_duplicates()
+
+    totals = pd.DataFrame(block[pairs["row"].to_numpy()])
+    totals = totals.groupby(pairs["group"].to_numpy()).sum()
+
+    # sectors and overall in their usual order (0 if nothing rolled up)
+    group_ids = [x[0] for x in context["sectors"]]
+    totals = totals.reindex(group_ids, fill_value=0)
+
+    return value_frame(group_ids, [x[0] for x in normal_properties], totals)
+
+
+def child_percentages(values, child_of):
+    """
+    each value as a fraction of its parent property's value
+    for the same authority (0 where there is no parent or it is 0)
+    child_of maps property ids to parent property ids
+    """
+    parent_ids = values["property_id"].map(child_of)
+    has_parent = parent_ids.notnull().to_numpy()
+
+    lookup = values.drop_duplicates(["authority_id", "property_id"], keep="last")
+    lookup = lookup.set_index(["authority_id", "property_id"])["value"]
+    index = pd.MultiIndex.from_arrays(
+        [values["authority_id"], parent_ids.fillna(-1).astype(np.int64)]
+    )
+    parent_values = lookup.reindex(index).to_numpy(dtype=float)
+
+    value = values["value"].to_numpy(dtype=float)
+    valid = has_parent & ~np.isnan(parent_values) & (parent_values != 0)
+    percentages = np.zeros(len(values))
+    np.divide(value, parent_values, out=percentages, where=valid)
+    return percentages
+
+
+def build_year(context, year_number):
+    """
+    build all values for a year from the adapter's files
+    context comes from Jurisdiction.year_context and this doesn't touch
+    the database, so can be run in a worker process
+    """
+    importlib.import_module(context["adapter_module"])
+    adapter_class = AdapterRegistry.get(context["slug"])
+    adapter = adapter_class(context["resources_folder"])
+
+    df = adapter.cleaned_year(
+        year_number, context["authority_lookup"], context["table_cache"]
+    )
+
+    # load the ordinary values where it's just a number
+    values = authority_values(
+        df,
+        context["authority_lookup"],
+        context["normal_properties"],
+        adapter.authority_name_column,
+        adapter.overall_total_column,
+    )
+
+    # roll the authorities up into sectors and the overall authority
+    rollup = rollup_values(df, context, adapter.authority_name_column)
+    values = pd.concat([values, rollup], ignore_index=True)
+
+    # calculate the dynamic values made from combinations of others
+    derived = context["derived"]
+    if len(derived):
+        values = pd.concat([values, derived.evaluate(values)], ignore_index=True)
+
+    # calculate percentage values for children
+    values["percentage_value"] = child_percentages(values, context["child_of"])
+    return values
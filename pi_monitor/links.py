@@ -0,0 +1,120 @@
+"""
+Paths to every page of a jurisdiction, worked out once per process
+
+Tables on most pages link to every authority, property or year, and
+calling reverse() for each of those cells on every baked page adds up.
+The registry reverses each url name once with placeholder arguments and
+fills in the slugs from the value cube's labels, so links are dict lookups.
+"""
+
+from urllib.parse import quote
+
+from django.urls import reverse
+from django.utils.html import conditional_escape
+
+from .cube import year_slug
+
+# registries built in this process, by jurisdiction slug
+_registries = {}
+
+# characters reverse() leaves unquoted in arguments
+SAFE_CHARACTERS = "!$&'()*+,;=/~:@"
+
+URL_ARGS = {
+    "pi.home": 1,
+    "pi.year": 2,
+    "pi.property": 3,
+    "pi.body": 3,
+    "pi.bodystat": 3,
+}
+
+
+def get_link(x, y):
+    return '<a href="{1}">{0}</a>'.format(conditional_escape(x), y)
+
+
+class LinkRegistry(object):
+    """
+    paths keyed by (url_name, args)
+    """
+
+    def __init__(self, cube, jurisdiction_slug):
+        self.labels_digest = cube.labels_digest()
+        self.jurisdiction_slug = jurisdiction_slug
+        self.templates = {}
+        self.paths = {}
+        self._body_links = {}
+
+        authorities = cube.authorities
+        self.authorities = list(zip(authorities["slug"], authorities["name"]))
+        self.render_full = set(authorities["slug"][authorities["render_full"]])
+        property_slugs = cube.properties["slug"].tolist()
+        year_slugs = [year_slug(x) for x in cube.year_numbers.tolist()]
+
+        j = jurisdiction_slug
+        self.add("pi.home", [(j,)])
+        self.add("pi.year", [(j, y) for y in year_slugs])
+        self.add("pi.property", [(j, p, y) for p in property_slugs for y in year_slugs])
+        self.add(
+            "pi.body", [(j, a, y) for a, _ in self.authorities for y in year_slugs]
+        )
+        self.add(
+            "pi.bodystat",
+            [(j, a, p) for a in sorted(self.render_full) for p in property_slugs],
+        )
+
+    @classmethod
+    def for_jurisdiction(cls, jurisdiction):
+        cube = jurisdiction.cube()
+        registry = _registries.get(jurisdiction.slug)
+        if registry is None or registry.labels_digest != cube.labels_digest():
+            registry = cls(cube, jurisdiction.slug)
+            _registries[jurisdiction.slug] = registry
+        return registry
+
+    def template(self, url_name):
+        """
+        the path for a url with numbered placeholders for its arguments
+        """
+        if url_name not in self.templates:
+            placeholders = ["__arg{0}__".format(x) for x in range(URL_ARGS[url_name])]
+            self.templates[url_name] = (
+                reverse(url_name, args=placeholders),
+                placeholders,
+            )
+        return self.templates[url_name]
+
+    def fill(self, url_name, args):
+        path, placeholders = self.template(url_name)
+        for placeholder, arg in zip(placeholders, args):
+            path = path.replace(placeholder, quote(str(arg), safe=SAFE_CHARACTERS))
+        return path
+
+    def add(self, url_name, all_args):
+        for args in all_args:
+            self.paths[(url_name, args)] = self.fill(url_name, args)
+
+    def path(self, url_name, *args):
+        """
+        the path for a page, as reverse(url_name, args=args) would give
+        """
+        key = (url_name, args)
+        if key not in self.paths:
+            self.paths[key] = reverse(url_name, args=args)
+        return self.paths[key]
+
+    def link(self, text, url_name, *args):
+        return get_link(text, self.path(url_name, *args))
+
+    def body_links(self, year_slug):
+        """
+        links to every authority's page for a year, by authority slug
+        """
+        if year_slug not in self._body_links:
+            self._body_links[year_slug] = {
+                slug: self.link(
+                    name, "pi.body", self.jurisdiction_slug, slug, year_slug
+                )
+                for slug, name in self.authorities
+            }
+        return self._body_links[year_slug]
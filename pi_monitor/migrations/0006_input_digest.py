@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pi_monitor", "0005_authority_render_full"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="jurisdiction",
+            name="input_digest",
+            field=models.CharField(default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="year",
+            name="input_digest",
+            field=models.CharField(default="", max_length=64),
+        ),
+    ]
@@ -0,0 +1,61 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_denormalised(apps, schema_editor):
+    """
+    copy the year fields onto existing values
+    """
+    schema_editor.execute(
+        """
+        UPDATE pi_monitor_value SET
+            jurisdiction_id = (
+                SELECT y.jurisdiction_id FROM pi_monitor_year y
+                WHERE y.id = pi_monitor_value.year_id
+            ),
+            year_number = (
+                SELECT y.number FROM pi_monitor_year y
+                WHERE y.id = pi_monitor_value.year_id
+            )
+        """
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pi_monitor", "0006_input_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="value",
+            name="jurisdiction",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="values",
+                to="pi_monitor.jurisdiction",
+            ),
+        ),
+        migrations.AddField(
+            model_name="value",
+            name="year_number",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_denormalised, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="value",
+            index=models.Index(
+                fields=["jurisdiction", "year_number"],
+                name="value_jurisdiction_year",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="value",
+            index=models.Index(
+                fields=["authority", "year_number", "property"],
+                name="value_authority_year",
+            ),
+        ),
+    ]
@@ -0,0 +1,43 @@
+import django.utils.timezone
+import django_sourdough.models.mixins
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pi_monitor", "0007_value_denormalised"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DataGeneration",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "batch_time",
+                    models.DateTimeField(blank=True, editable=False, null=True),
+                ),
+                (
+                    "batch_id",
+                    models.IntegerField(blank=True, editable=False, null=True),
+                ),
+                ("number", models.IntegerField(default=0)),
+                (
+                    "updated",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+            bases=(models.Model, django_sourdough.models.mixins.StockModelHelpers),
+        ),
+    ]
@@ -1,17 +1,25 @@
+import copy
+import hashlib
 import importlib
 import os
-from itertools import groupby
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 from research_common.charts import Table, query_to_df
 from django.conf import settings
-from django.db import models
-from django.urls import reverse
-from django.utils.html import conditional_escape, escape
+from django.db import connection, connections, models, transaction
+from django.utils import timezone
+from django.utils.html import escape
 from django.utils.text import slugify
 
+from . import frames
 from .adapters.base import dataframe_to_map
+from .cube import ValueCube, cube_folder, remove_cube
+from .derived import DerivedProperties
+from .links import LinkRegistry
 from django_sourdough.models import FlexiBulkModel
 
 from .adapters import AdapterRegistry
@@ -19,6 +27,9 @@ from .adapters import AdapterRegistry
 for a in settings.PI_ADAPTERS:
     importlib.import_module(a)
 
+# property ids are allocated in blocks of this size per jurisdiction
+PROPERTY_ID_BLOCK = 100000
+
 
 def fix_percentage(v):
     return round(v * 100, 2)
@@ -28,54 +39,400 @@ def intcomma(x):
     return "{:,}".format(x)
 
 
-def get_link(x, y):
-    return '<a href="{1}">{0}</a>'.format(conditional_escape(x), y)
+STATS_TREE_HEADER = {
+    "authority_id": "authority_id",
+    "property__slug": "Property",
+    "property__child_of_id": "parent_group",
+    "value": "Value",
+    "percentage_value": "%",
+}
 
 
-def zero_if_none(v):
+def describe_plan(plan):
     """
-    return 0 if none
+    readable summary of what populate is going to rebuild
+    """
+    for entry in plan:
+        slug = entry["slug"]
+        if entry["rebuild"]:
+            yield "{0}: rebuild everything".format(slug)
+            continue
+        years = ["alltime" if x == 9999 else str(x) for x in entry["years"]]
+        if years:
+            yield "{0}: rebuild years {1}".format(slug, ", ".join(years))
+        if entry["remove_years"]:
+            removed = ", ".join(str(x) for x in entry["remove_years"])
+            yield "{0}: remove years {1}".format(slug, removed)
+        if not years and not entry["remove_years"]:
+            yield "{0}: up to date".format(slug)
+
+
+class TableDeleter(object):
+    """
+    removes a jurisdiction's rows for populate
+
+    delete() on a queryset has django collect every related row into
+    memory to cascade by hand, which for values is most of the database.
+    with fast, each table is cleared with one DELETE statement instead,
+    children before parents, in a transaction.
+    either way, the rows removed and time taken are kept for report()
     """
-    if v:
-        if pd.isnull(v):
-            return 0
-        if v == "-":
-            return 0
-        if v == "--":
-            return 0
-        if isinstance(v, str):
-            v = v.strip()
-            if not v:
-                return 0
-            # if "," in v:
-            #    v = v.replace(",", "")
-            return int(v)
-        if isinstance(v, int):
-            return v
-        if isinstance(v, float):
-            return int(v)
-        else:
-            return 0
-    else:
-        return 0
+
+    def __init__(self, fast=False):
+        self.fast = fast
+        self.timings = []
+
+    def record(self, label, rows, start):
+        self.timings.append((label, rows, time.perf_counter() - start))
+
+    def orm_delete(self, label, queryset):
+        start = time.perf_counter()
+        rows, _ = queryset.delete()
+        self.record(label, rows, start)
+
+    def execute(self, label, model, where, params):
+        sql = "DELETE FROM {table} WHERE {where}".format(
+            table=connection.ops.quote_name(model._meta.db_table), where=where
+        )
+        start = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.rowcount
+        self.record(label, rows, start)
+
+    def where(self, column, value, numbers=None):
+        """
+        condition on a column (and optionally on the year number)
+        """
+        qn = connection.ops.quote_name
+        where = "{0} = %s".format(qn(column))
+        params = [value]
+        if numbers is not None:
+            where += " AND {0} IN ({1})".format(
+                qn("number"), ", ".join(["%s"] * len(numbers))
+            )
+            params += list(numbers)
+        return where, params
+
+    def where_in(self, column, model, jurisdiction, numbers=None):
+        """
+        condition on column pointing to one of a jurisdiction's rows in model
+        """
+        qn = connection.ops.quote_name
+        where, params = self.where("jurisdiction_id", jurisdiction.id, numbers)
+        where = "{column} IN (SELECT {id} FROM {table} WHERE {where})".format(
+            column=qn(column),
+            id=qn("id"),
+            table=qn(model._meta.db_table),
+            where=where,
+        )
+        return where, params
+
+    def values(self, year):
+        if not self.fast:
+            return self.orm_delete("values", year.values.all())
+        self.execute("values", Value, *self.where("year_id", year.id))
+
+    def years(self, jurisdiction, numbers=None):
+        """
+        all of a jurisdiction's years, or those with these numbers
+        """
+        if numbers is not None and not len(numbers):
+            return
+        if not self.fast:
+            years = jurisdiction.years.all()
+            if numbers is not None:
+                years = years.filter(number__in=numbers)
+            return self.orm_delete("years", years)
+        with transaction.atomic():
+            where = self.where_in("year_id", Year, jurisdiction, numbers)
+            self.execute("values", Value, *where)
+            where = self.where("jurisdiction_id", jurisdiction.id, numbers)
+            self.execute("years", Year, *where)
+
+    def clear(self, label, model, column, jurisdiction):
+        """
+        clear one of a jurisdiction's tables, and the values that point to it
+        """
+        with transaction.atomic():
+            where = self.where_in(column, model, jurisdiction)
+            self.execute("values", Value, *where)
+            where = self.where("jurisdiction_id", jurisdiction.id)
+            self.execute(label, model, *where)
+
+    def authorities(self, jurisdiction):
+        if not self.fast:
+            return self.orm_delete("authorities", jurisdiction.authorities.all())
+        self.clear("authorities", Authority, "authority_id", jurisdiction)
+
+    def properties(self, jurisdiction):
+        if not self.fast:
+            return self.orm_delete("properties", jurisdiction.properties.all())
+        self.clear("properties", Property, "property_id", jurisdiction)
+
+    def jurisdiction(self, jurisdiction):
+        if not self.fast:
+            queryset = Jurisdiction.objects.filter(id=jurisdiction.id)
+            return self.orm_delete("jurisdictions", queryset)
+        with transaction.atomic():
+            self.years(jurisdiction)
+            self.authorities(jurisdiction)
+            self.properties(jurisdiction)
+            where = self.where("id", jurisdiction.id)
+            self.execute("jurisdictions", Jurisdiction, *where)
+
+    def report(self):
+        """
+        rows and time for each table
+        """
+        if not self.timings:
+            return
+        totals = {}
+        for label, rows, seconds in self.timings:
+            total = totals.setdefault(label, [0, 0, 0.0])
+            total[0] += 1
+            total[1] += rows
+            total[2] += seconds
+        print("deletes ({0}):".format("set based" if self.fast else "ORM"))
+        for label, (statements, rows, seconds) in totals.items():
+            print(
+                "  {0}: {1:,} rows in {2:.2f}s ({3} statements)".format(
+                    label, rows, seconds, statements
+                )
+            )
+
+
+class DataGeneration(FlexiBulkModel):
+    """
+    counter bumped whenever populate changes the data
+    cached responses and ETags are keyed on it
+    """
+
+    number = models.IntegerField(default=0)
+    updated = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def current(cls):
+        generation = cls.objects.filter(id=1).first()
+        if generation is None:
+            # don't write here - this is read while serving and baking
+            generation = cls(id=1, number=0, updated=timezone.now())
+        return generation
+
+    @classmethod
+    def bump(cls):
+        generation = cls.current()
+        generation.number += 1
+        generation.updated = timezone.now()
+        generation.save()
+        print("data generation {0}".format(generation.number))
+        return generation
 
 
 class Jurisdiction(FlexiBulkModel):
     name = models.CharField(max_length=255)
     slug = models.CharField(max_length=255)
     desc = models.CharField(max_length=255, default="")
+    input_digest = models.CharField(max_length=64, default="")
 
     def get_special(self, special):
         prop = self.properties.get(special)
         return prop
 
     @classmethod
-    def populate(cls):
-        cls.objects.all().delete()
-        for slug, adapter in AdapterRegistry.registry.items():
-            new = cls(name=adapter.name, slug=adapter.slug, desc=adapter.desc)
-            new.save()
-            new.populate_jurisdiction()
+    def populate(cls, jobs=1, full=False, dry_run=False, fast_delete=False):
+        """
+        bring all jurisdictions up to date with their adapters' files
+
+        only jurisdictions and years whose input files have changed since
+        the last run are rebuilt - use full to rebuild everything
+        (e.g. when the adapter or loading code has changed).
+        with jobs > 1, years are built in a pool of worker processes
+        and written back here in the same order as a serial run
+        fast_delete clears old rows with set based DELETEs (see TableDeleter)
+        """
+        plan = cls.populate_plan(full=full)
+        for line in describe_plan(plan):
+            print(line)
+        if dry_run:
+            return plan
+
+        deleter = TableDeleter(fast=fast_delete)
+        stale = cls.objects.exclude(slug__in=list(AdapterRegistry.registry.keys()))
+        stale_slugs = []
+        for j in stale:
+            stale_slugs.append(j.slug)
+            remove_cube(j.slug)
+            deleter.jurisdiction(j)
+
+        pool = None
+        if jobs > 1:
+            # workers never touch the database, but shouldn't inherit a connection
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=jobs)
+
+        pending = []
+        changed = []
+        try:
+            for entry in plan:
+                j = entry["jurisdiction"]
+                if entry["rebuild"]:
+                    if j:
+                        deleter.jurisdiction(j)
+                    adapter = entry["adapter"]
+                    j = cls(name=adapter.name, slug=adapter.slug, desc=adapter.desc)
+                    j.save()
+                    j.populate_properties(deleter)
+                    j.populate_authorities(deleter)
+                    j.input_digest = entry["digest"]
+                    j.save()
+
+                deleter.years(j, entry["remove_years"])
+                years = j.create_years(list(entry["years"].keys()))
+                if years or entry["remove_years"]:
+                    changed.append(j)
+                if not years:
+                    continue
+                context = j.year_context()
+                for y in years:
+                    future = None
+                    if pool:
+                        future = pool.submit(frames.build_year, context, y.number)
+                    pending.append((y, context, future, entry["years"][y.number]))
+
+            for y, context, future, digest in pending:
+                print("writing {0} {1}".format(y.jurisdiction.slug, y.slug))
+                values = future.result() if future else None
+                y.load_year(context, values=values, deleter=deleter)
+                y.input_digest = digest
+                y.save()
+        finally:
+            if pool:
+                pool.shutdown()
+
+        for j in changed:
+            print("saving value cube for {0}".format(j.slug))
+            j.save_cube()
+
+        if changed or stale_slugs:
+            DataGeneration.bump()
+
+        deleter.report()
+        return plan
+
+    @classmethod
+    def populate_plan(cls, full=False):
+        """
+        work out what needs rebuilding from hashes of the files
+        each jurisdiction and year depends on
+        """
+        plan = []
+        for slug, adapter_class in AdapterRegistry.registry.items():
+            existing = cls.objects.filter(slug=slug).first()
+            adapter = cls(slug=slug).adapter()
+
+            digest = adapter.structure_digest()
+            rebuild = full or existing is None or existing.input_digest != digest
+
+            year_digests = {
+                x: adapter.year_digest(x)
+                for x in range(adapter.start_year, adapter.end_year + 1)
+            }
+            # all time depends on its own files and every year being the same
+            h = hashlib.sha256(adapter.year_digest(9999).encode())
+            for number, year_digest in sorted(year_digests.items()):
+                h.update("{0}:{1}".format(number, year_digest).encode())
+            year_digests[9999] = h.hexdigest()
+
+            remove_years = []
+            if not rebuild:
+                current = dict(existing.years.values_list("number", "input_digest"))
+                remove_years = [x for x in current if x not in year_digests]
+                year_digests = {
+                    x: d for x, d in year_digests.items() if current.get(x) != d
+                }
+
+            plan.append(
+                {
+                    "slug": slug,
+                    "adapter": adapter_class,
+                    "jurisdiction": existing,
+                    "digest": digest,
+                    "rebuild": rebuild,
+                    "years": year_digests,
+                    "remove_years": remove_years,
+                }
+            )
+        return plan
+
+    def year_context(self):
+        """
+        everything needed to build a year's values without the database
+        """
+        adapter_class = AdapterRegistry.get(self.slug)
+        properties = list(self.properties.all().order_by("id"))
+        children = defaultdict(list)
+        for p in properties:
+            if p.child_of_id:
+                children[p.child_of_id].append(p.id)
+
+        authorities = list(self.authorities.all())
+        sectors = [x for x in authorities if x.is_sector]
+        sectors += [x for x in authorities if x.is_overall]
+        bodies = [x for x in authorities if not x.is_sector and not x.is_overall]
+        by_id = {x.id: x for x in authorities}
+
+        def ancestors(authority):
+            """
+            the sectors above an authority, nearest first
+            """
+            found = []
+            parent = by_id.get(authority.sector_id)
+            while parent and not parent.is_overall and parent.id not in found:
+                found.append(parent.id)
+                parent = by_id.get(parent.sector_id)
+            return found
+
+        return {
+            "slug": self.slug,
+            "adapter_module": adapter_class.__module__,
+            "resources_folder": self.resources_folder,
+            "authority_lookup": {x.name: x.id for x in authorities},
+            "ancestors": {x.name: ancestors(x) for x in bodies},
+            "overall_id": [x.id for x in authorities if x.is_overall][0],
+            "sectors": [(x.id, x.name, x.is_overall) for x in sectors],
+            "table_cache": settings.ADAPTER_TABLE_CACHE,
+            "normal_properties": [(p.id, p.name) for p in properties if not p.dynamic],
+            "derived": DerivedProperties(
+                [(p.id, p.slug, p.dynamic, children[p.id]) for p in properties]
+            ),
+            "child_of": {p.id: p.child_of_id for p in properties if p.child_of_id},
+        }
+
+    def cube(self):
+        """
+        dense array of all values for this jurisdiction
+        """
+        return ValueCube.for_jurisdiction(self)
+
+    def links(self):
+        """
+        paths to every page for this jurisdiction
+        """
+        return LinkRegistry.for_jurisdiction(self)
+
+    def cleaned_year(self, year_number):
+        """
+        the adapter's cleaned DataFrame for a year, as populate sees it
+        read from the table cache where it's current
+        """
+        lookup = dict(self.authorities.values_list("name", "id"))
+        return self.adapter().cleaned_year(
+            year_number, lookup, settings.ADAPTER_TABLE_CACHE
+        )
+
+    def save_cube(self):
+        ValueCube.from_database(self).save(cube_folder(self.slug))
 
     @property
     def resources_folder(self):
@@ -101,27 +458,33 @@ class Jurisdiction(FlexiBulkModel):
         adapter = self.adapter()
         return range(adapter.start_year, adapter.end_year + 1)
 
-    def populate_jurisdiction(self):
-        self.populate_properties()
-        self.populate_authorities()
-        self.populate_years()
-
-    def populate_years(self):
-        Year.objects.filter(jurisdiction=self).delete()
-        for y in self.year_range():
-            Year(jurisdiction=self, number=y, display=str(y), slug=str(y)).queue()
-        Year(
-            jurisdiction=self, number="9999", display="All time", slug="alltime"
-        ).queue()
+    def create_years(self, numbers=None):
+        """
+        make sure there is a Year for each number (default all of them)
+        and return those years
+        """
+        if numbers is None:
+            numbers = list(self.year_range()) + [9999]
+        existing = set(
+            self.years.filter(number__in=numbers).values_list("number", flat=True)
+        )
+        for y in numbers:
+            if y in existing:
+                continue
+            if y == 9999:
+                Year(
+                    jurisdiction=self, number=9999, display="All time", slug="alltime"
+                ).queue()
+            else:
+                Year(jurisdiction=self, number=y, display=str(y), slug=str(y)).queue()
         Year.save_queue()
-        for y in self.years.all():
-            y.load_year()
+        return list(self.years.filter(number__in=numbers).order_by("id"))
 
-    def populate_properties(self):
+    def populate_properties(self, deleter=None):
         adapter = self.adapter()
         df = adapter.get_properties()
 
-        self.properties.all().delete()
+        (deleter or TableDeleter()).properties(self)
 
         name_to_id = dataframe_to_map(df, "value", "id")
 
@@ -130,18 +493,14 @@ class Jurisdiction(FlexiBulkModel):
         has_children = []
         to_create = []
 
-        existing = Property.objects.all().order_by("-id")
-
-        if existing.exists():
-            latest_id = existing[0].id
-        else:
-            latest_id = 0
-
         df = df.replace({np.nan: None})
         for index, r in df.iterrows():
-            latest_id += 1
+            # ids are fixed by the jurisdiction and the local id, rather than
+            # read from the current highest id, so don't depend on what else
+            # has been written to the table
+            property_id = self.id * PROPERTY_ID_BLOCK + int(r["id"])
             c = Property(
-                id=latest_id,
+                id=property_id,
                 local_id=int(r["id"]),
                 name=r["value"].strip(),
                 slug=d_slugify(r["value"].strip()),
@@ -151,7 +510,7 @@ class Jurisdiction(FlexiBulkModel):
                 jurisdiction=self,
             )
 
-            local_to_global[int(r["id"])] = latest_id
+            local_to_global[int(r["id"])] = property_id
             if pd.notnull(r["child_of"]):
                 local_id = name_to_id[r["child_of"]]
                 global_id = local_to_global[local_id]
@@ -179,11 +538,11 @@ class Jurisdiction(FlexiBulkModel):
             "sector__name", "name"
         )
 
-    def populate_authorities(self):
+    def populate_authorities(self, deleter=None):
         adapter = self.adapter()
         df = adapter.get_authorities()
 
-        self.authorities.all().delete()
+        (deleter or TableDeleter()).authorities(self)
 
         all_auths = Authority(
             jurisdiction=self,
@@ -199,32 +558,46 @@ class Jurisdiction(FlexiBulkModel):
                 return True
             return False
 
-        for index, r in df.iterrows():
-            if pd.isnull(r["sector"]):
+        # sectors are rows without a sector, or that other rows name as theirs
+        # (a sector inside a larger one) - made a level at a time, so
+        # each one's parent already has an id
+        names = df[adapter.authority_name_column]
+        is_sector = df["sector"].isnull() | names.isin(df["sector"].dropna())
+        sectors = {}
+        pending = df[is_sector]
+        while len(pending):
+            ready = pending["sector"].isnull() | pending["sector"].isin(list(sectors))
+            if not ready.any():
+                raise ValueError(
+                    "sectors in {0} contain each other: {1}".format(
+                        adapter.authorites_desc_file,
+                        ", ".join(pending[adapter.authority_name_column]),
+                    )
+                )
+            for index, r in pending[ready].iterrows():
+                parent = r["sector"]
                 Authority(
                     jurisdiction=self,
                     name=r[adapter.authority_name_column],
                     slug=slugify(r[adapter.authority_name_column]),
                     local_id=r["authority_id"],
-                    sector=all_auths,
+                    sector_id=sectors[parent] if pd.notnull(parent) else all_auths.id,
                     is_sector=True,
                     render_full=num_to_boolean(r["render_full"]),
                 ).queue()
+            sectors.update({x.name: x.id for x in Authority.save_queue()})
+            pending = pending[~ready]
 
-        sectors = Authority.save_queue()
-        sectors = {x.name: x.id for x in sectors}
-
-        for index, r in df.iterrows():
-            if pd.notnull(r["sector"]):
-                Authority(
-                    jurisdiction=self,
-                    name=r[adapter.authority_name_column],
-                    slug=slugify(r[adapter.authority_name_column]),
-                    local_id=r["authority_id"],
-                    sector_id=sectors[r["sector"]],
-                    is_sector=False,
-                    render_full=num_to_boolean(r["render_full"]),
-                ).queue()
+        for index, r in df[~is_sector].iterrows():
+            Authority(
+                jurisdiction=self,
+                name=r[adapter.authority_name_column],
+                slug=slugify(r[adapter.authority_name_column]),
+                local_id=r["authority_id"],
+                sector_id=sectors[r["sector"]],
+                is_sector=False,
+                render_full=num_to_boolean(r["render_full"]),
+            ).queue()
         Authority.save_queue()
 
 
@@ -240,101 +613,21 @@ class Year(FlexiBulkModel):
     display = models.CharField(max_length=20)
     slug = models.CharField(max_length=20, default="")
     file_name = models.CharField(max_length=20)
+    input_digest = models.CharField(max_length=64, default="")
 
-    def load_year(self):
+    def load_year(self, context=None, values=None, deleter=None):
         """
         load all values in for the year
+        values (with their final percentages) can be passed in if they
+        have already been built (in a worker process - see Jurisdiction.populate)
         """
+        if values is None:
+            if context is None:
+                context = self.jurisdiction.year_context()
+            values = frames.build_year(context, self.number)
 
-        adapter = self.jurisdiction.adapter()
-
-        authorities = self.jurisdiction.authorities.all()
-        authority_lookup = {x.name: x.id for x in authorities}
-
-        df = adapter.get_year(self.number, authority_lookup)
-
-        self.values.all().delete()
-
-        normal_properties = self.jurisdiction.properties.filter(dynamic=None)
-        combo_properties = self.jurisdiction.properties.exclude(dynamic=None)
-
-        # load the ordinary values where it's just a number
-        for index, r in df.iterrows():
-            # don't load blank rows
-            if pd.isnull(r[adapter.overall_total_column]):
-                continue
-            authority_name = r[adapter.authority_name_column]
-            authority_id = authority_lookup.get(authority_name, None)
-            if authority_id:  # skip those that only appeared once with no values
-                for n in normal_properties:
-                    v = zero_if_none(r[n.name])
-                    if v == "":
-                        v = 0
-                    # if n.special:
-                    #    print (n.special,r[n.name], v)
-                    Value(
-                        authority_id=authority_id, property=n, year=self, value=v
-                    ).queue()
-
-        # generate sectors totals for sector counts and overall
-        print("generating sector values")
-        sectors = list(self.jurisdiction.authorities.filter(is_sector=True))
-        all_time = self.jurisdiction.authorities.get(is_overall=True)
-
-        sector_lookup = {
-            x.name: x.sector.name
-            for x in self.jurisdiction.bodies().prefetch_related("sector")
-        }
-
-        df["sector"] = df[adapter.authority_name_column].map(sector_lookup)
-        for s in sectors + [all_time]:
-            if s.is_overall:
-                reduced = df
-            else:
-                reduced = df[df["sector"] == s.name]
-            for n in normal_properties:
-                v = pd.to_numeric(reduced[n.name], errors="coerce").sum()
-                if s.is_overall:
-                    print(n.name, v)
-                Value(authority_id=s.id, property=n, year=self, value=v).queue()
-
-        ordinary_values = Value.save_queue(safe_creation_rate=10000)
-
-        print("calculating dynamic values")
-
-        # calculate the dynamic values made from combinations of others
-        def authority_key(x):
-            return x.authority_id
-
-        ordinary_values.sort(key=authority_key)
-        for authority_id, values in groupby(ordinary_values, key=authority_key):
-            value_lookup = {x.property_id: int(x.value) for x in values}
-            for c in combo_properties:
-                v = c.generate_value(value_lookup)
-                v.authority_id = authority_id
-                v.year = self
-                v.queue()
-
-        Value.save_queue()
-
-        # calculate percentage values for children
-        properties = list(self.jurisdiction.properties.all())
-        to_update = []
-        all_values = list(Value.objects.filter(year=self).order_by("authority"))
-        for authority_id, values in groupby(all_values, key=authority_key):
-            values = list(values)
-            value_lookup = {x.property_id: x for x in values}
-            for p in properties:
-                if p.child_of_id:
-                    base = value_lookup[p.id]
-                    parent = value_lookup[p.child_of_id]
-                    if parent.value:
-                        base.percentage_value = base.value / parent.value
-                    else:
-                        base.percentage_value = 0
-                    to_update.append(base)
-
-        Value.objects.bulk_update(to_update, ["percentage_value"])
+        (deleter or TableDeleter()).values(self)
+        Value.bulk_insert(self, values)
 
 
 class Authority(FlexiBulkModel):
@@ -356,13 +649,14 @@ class Authority(FlexiBulkModel):
         self.stats = None
 
     def valid_years(self):
-        return self.jurisdiction.years.filter(values__authority=self).distinct()
+        numbers = self.jurisdiction.cube().years_present(authorities=[self.id])
+        return self.jurisdiction.years.filter(number__in=numbers)
 
     def get_stats(self, year):
         """
         get all stats for this authority and year
         """
-        v = Value.objects.filter(year=year, authority=self)
+        v = Value.objects.filter(authority=self, year_number=year.number)
         v = v.order_by("property_id").prefetch_related("property")
         return v
 
@@ -376,58 +670,28 @@ class Authority(FlexiBulkModel):
     def prepare_stats_as_tree(self, year):
         """
         Structure so there's easy comparison of percentage value
+        (StatsTrees does this for every authority in a year at once)
         """
         j = self.jurisdiction
 
-        lp = list(j.properties.all().order_by("local_id"))
-        child_props = list(set([x.child_of_id for x in lp if x.child_of_id]))
-        props_with_children = [x for x in lp if x.id in child_props]
-        slug_to_prop = {x.slug: x for x in lp}
-
-        def get_property_link(property_slug):
-            prop = slug_to_prop[property_slug]
-            url = reverse(
-                "pi.property", args=(prop.jurisdiction.slug, prop.slug, year.slug)
-            )
-            return get_link(escape(prop.name), url)
-
-        def get_linked_value(row):
-            property_slug = row["Property"]
-
-            value = intcomma(int(row["Value"]))
-            if not self.render_full:
-                return value
-            prop = slug_to_prop[property_slug]
-            url = reverse(
-                "pi.bodystat", args=(prop.jurisdiction.slug, self.slug, prop.slug)
-            )
-            return get_link(value, url)
-
         # authority stats
 
         sectors = [self.id]
         if self.sector_id:
             sectors.append(self.sector_id)
 
-        stats = Value.objects.filter(year=year, authority__in=sectors)
+        stats = Value.objects.filter(authority__in=sectors, year_number=year.number)
         stats = stats.order_by("-value")
         stats = stats.prefetch_related("authority", "property")
 
-        header = {
-            "authority_id": "authority_id",
-            "property__slug": "Property",
-            "property__child_of_id": "parent_group",
-            "value": "Value",
-            "percentage_value": "%",
-        }
-
-        main_df = query_to_df(stats, header)
+        main_df = query_to_df(stats, STATS_TREE_HEADER)
 
         df = main_df[main_df["authority_id"] == self.id]
         df = df.drop(columns=["authority_id"])
 
         # parent_stats
 
+        sector_label = None
         if self.sector_id:
             if self.sector.is_overall:
                 sector_label = "Overall %"
@@ -442,11 +706,40 @@ class Authority(FlexiBulkModel):
 
             df = df.merge(parent_df, on=["Property"])
 
+        properties = list(j.properties.all().order_by("local_id"))
+        return self.stats_tree_tables(year, df, sector_label, properties)
+
+    def stats_tree_tables(self, year, df, sector_label, properties):
+        """
+        a table for each property with children, from a frame of
+        this authority's values with its sector's percentages alongside
+        """
+        j = self.jurisdiction
+        child_props = set([x.child_of_id for x in properties if x.child_of_id])
+        # copies, as each authority's tree gets its own tables
+        props_with_children = [copy.copy(x) for x in properties if x.id in child_props]
+        slug_to_prop = {x.slug: x for x in properties}
+        links = j.links()
+
+        def get_property_link(property_slug):
+            prop = slug_to_prop[property_slug]
+            return links.link(
+                escape(prop.name), "pi.property", j.slug, prop.slug, year.slug
+            )
+
+        def get_linked_value(row):
+            property_slug = row["Property"]
+
+            value = intcomma(int(row["Value"]))
+            if not self.render_full:
+                return value
+            return links.link(value, "pi.bodystat", j.slug, self.slug, property_slug)
+
         for p in props_with_children:
             reduced_df = df[(df["Property"] == p.slug) | (df["parent_group"] == p.id)]
             reduced_df = reduced_df.drop("parent_group", axis="columns")
             reduced_df.loc[df["Property"] == p.slug, "%"] = 1
-            if self.sector:
+            if sector_label:
                 reduced_df.loc[df["Property"] == p.slug, sector_label] = 1
             title = ""
             p.table = Table(name=title)
@@ -455,12 +748,59 @@ class Authority(FlexiBulkModel):
             p.table.format["Property"] = get_property_link
             p.table.format_on_row["Value"] = get_linked_value
             p.table.format["%"] = fix_percentage
-            if self.sector:
+            if sector_label:
                 p.table.format[sector_label] = fix_percentage
 
         return props_with_children
 
 
+class StatsTrees(object):
+    """
+    the stats trees (see Authority.prepare_stats_as_tree) for every
+    authority in a year, from one slice of the value cube
+    each authority's tables are made when asked for
+    """
+
+    def __init__(self, jurisdiction, year):
+        self.year = year
+        self.properties = list(jurisdiction.properties.all().order_by("local_id"))
+
+        cube = jurisdiction.cube()
+        self.overall_id = cube.overall_id()
+        df = cube.query(STATS_TREE_HEADER, years=[year.number], order_by=["-value"])
+
+        # line up each value with the same property for the authority's sector
+        df["sector_id"] = df["authority_id"].map(cube.authorities["sector_id"])
+        df["sector_id"] = df["sector_id"].astype(float)
+        parent = df[["authority_id", "Property", "%"]].rename(
+            columns={"authority_id": "sector_id", "%": "parent %"}
+        )
+        parent["sector_id"] = parent["sector_id"].astype(float)
+        df = df.merge(parent, on=["sector_id", "Property"], how="left")
+        has_sector = df["sector_id"].notnull()
+        df = df[~has_sector | df["parent %"].notnull()]
+
+        self.by_authority = {
+            authority_id: x.drop(columns=["authority_id"])
+            for authority_id, x in df.groupby("authority_id", sort=False)
+        }
+        self.empty = df.drop(columns=["authority_id"]).iloc[0:0]
+
+    def tree_for(self, authority):
+        df = self.by_authority.get(authority.id, self.empty)
+        df = df.drop(columns=["sector_id"])
+        sector_label = None
+        if authority.sector_id:
+            if authority.sector_id == self.overall_id:
+                sector_label = "Overall %"
+            else:
+                sector_label = "Sector %"
+            df = df.rename(columns={"parent %": sector_label})
+        else:
+            df = df.drop(columns=["parent %"])
+        return authority.stats_tree_tables(self.year, df, sector_label, self.properties)
+
+
 def d_slugify(v):
     return slugify(v).replace("-", "_")
 
@@ -480,14 +820,6 @@ class Property(FlexiBulkModel):
     special = models.CharField(max_length=255, null=True, blank=True)
     priority = models.IntegerField(default=0)
 
-    def generate_value(self, value_lookup: dict):
-        v = 0
-        if self.dynamic == "*children*":
-            child_ids = self.children.all().values_list("id", flat=True)
-            for c in child_ids:
-                v += value_lookup.get(c, 0)
-        return Value(property=self, value=v)
-
 
 class Value(FlexiBulkModel):
     authority = models.ForeignKey(
@@ -500,6 +832,76 @@ class Value(FlexiBulkModel):
     value = models.FloatField(default=0)
     percentage_value = models.FloatField(default=0)
 
+    # copies of fields from the year
+    # so the common filters don't need joins (filled by bulk_insert)
+    jurisdiction = models.ForeignKey(
+        Jurisdiction,
+        related_name="values",
+        on_delete=models.CASCADE,
+        null=True,
+        db_index=False,
+    )
+    year_number = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["jurisdiction", "year_number"],
+                name="value_jurisdiction_year",
+            ),
+            models.Index(
+                fields=["authority", "year_number", "property"],
+                name="value_authority_year",
+            ),
+        ]
+
+    @classmethod
+    def bulk_insert(cls, year, rows):
+        """
+        write a frame of authority_id, property_id, value
+        (and optionally percentage_value) rows for a year
+        straight to the table without building model instances
+        """
+        if not len(rows):
+            return 0
+        if "percentage_value" in rows.columns:
+            percentages = rows["percentage_value"].to_numpy(dtype=float).tolist()
+        else:
+            percentages = [0.0] * len(rows)
+
+        jurisdiction = year.jurisdiction
+        authority_ids = rows["authority_id"].to_numpy(dtype=np.int64).tolist()
+        property_ids = rows["property_id"].to_numpy(dtype=np.int64).tolist()
+
+        qn = connection.ops.quote_name
+        columns = [
+            "authority_id",
+            "property_id",
+            "year_id",
+            "value",
+            "percentage_value",
+            "jurisdiction_id",
+            "year_number",
+        ]
+        sql = "INSERT INTO {table} ({columns}) VALUES ({params})".format(
+            table=qn(cls._meta.db_table),
+            columns=", ".join(qn(x) for x in columns),
+            params=", ".join(["%s"] * len(columns)),
+        )
+        params = zip(
+            authority_ids,
+            property_ids,
+            [year.id] * len(rows),
+            rows["value"].to_numpy(dtype=float).tolist(),
+            percentages,
+            [jurisdiction.id] * len(rows),
+            [year.number] * len(rows),
+        )
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, params)
+        return len(rows)
+
     def display_percent(self):
         return round(self.percentage_value, 2) * 100
 
@@ -510,8 +912,8 @@ class Value(FlexiBulkModel):
         if self.authority.sector_id:
             parent_authority = self.authority.sector_id
             v = Value.objects.get(
-                property_id=self.property_id,
-                year_id=self.year_id,
                 authority_id=parent_authority,
+                year_number=self.year_number,
+                property_id=self.property_id,
             )
             return v
@@ -2,6 +2,8 @@
 from pi_monitor.models import Jurisdiction
 
 
-def populate():
+def populate(jobs=1, full=False, dry_run=False, fast_delete=False):
     print("running population")
-    Jurisdiction.populate()
+    Jurisdiction.populate(
+        jobs=jobs, full=full, dry_run=dry_run, fast_delete=fast_delete
+    )
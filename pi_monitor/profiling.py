@@ -0,0 +1,211 @@
+"""
+Opt in SQL profiling for the bake and the development server
+
+With SQL_PROFILE on, every statement run while rendering a page is
+recorded against a normalised form of the statement and the line in
+pi_monitor that ran it. Statements repeated SQL_PROFILE_THRESHOLD or
+more times on one page (usually a query in a loop) are
+flagged, and a report of the worst pages and query shapes is written to
+SQL_PROFILE_REPORT.
+"""
+
+import os
+import re
+import time
+import traceback
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+REPORT_ROWS = 25
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+IN_LIST_RE = re.compile(r"\bIN \((?:\s*(?:%s|\?)\s*,?)+\)", re.IGNORECASE)
+SPACE_RE = re.compile(r"\s+")
+
+
+def normalise(sql):
+    """
+    reduce a statement to its shape, so the same query with
+    different parameters is counted together
+    """
+    sql = STRING_RE.sub("?", sql)
+    sql = NUMBER_RE.sub("?", sql)
+    sql = sql.replace("%s", "?")
+    sql = IN_LIST_RE.sub("IN (...)", sql)
+    return SPACE_RE.sub(" ", sql).strip()
+
+
+def call_site():
+    """
+    the innermost line of this app's code that is running a query
+    """
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename == __file__:
+            continue
+        if frame.filename.startswith(APP_FOLDER):
+            return "{0}:{1} {2}".format(
+                os.path.relpath(frame.filename, APP_FOLDER), frame.lineno, frame.name
+            )
+    return "(outside pi_monitor)"
+
+
+def profiling_enabled():
+    return getattr(settings, "SQL_PROFILE", False)
+
+
+@contextmanager
+def capture_queries(enabled=True):
+    """
+    record (sql, call site, seconds) for each statement run in the block
+    yields None when not enabled, so it can wrap code unconditionally
+    """
+    if not enabled:
+        yield None
+        return
+
+    queries = []
+
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries.append((sql, call_site(), time.perf_counter() - start))
+
+    with connection.execute_wrapper(wrapper):
+        yield queries
+
+
+class SQLProfile(object):
+    """
+    statements grouped by page, shape and call site
+    """
+
+    def __init__(self, threshold=None):
+        if threshold is None:
+            threshold = getattr(settings, "SQL_PROFILE_THRESHOLD", 5)
+        self.threshold = threshold
+        # label: [queries, seconds, {(shape, site): count}]
+        self.pages = {}
+        # (shape, site): [queries, seconds, pages, pages where repeated]
+        self.shapes = {}
+
+    def add_page(self, label, queries):
+        """
+        add the queries run for a page
+        returns the (shape, site, count) that were repeated on the page
+        """
+        page = [0, 0.0, {}]
+        counts = {}
+        for sql, site, seconds in queries:
+            key = (normalise(sql), site)
+            counts[key] = counts.get(key, 0) + 1
+            page[0] += 1
+            page[1] += seconds
+            shape = self.shapes.setdefault(key, [0, 0.0, 0, 0])
+            shape[0] += 1
+            shape[1] += seconds
+
+        repeats = []
+        for key, count in counts.items():
+            self.shapes[key][2] += 1
+            if count >= self.threshold:
+                # only repeated shapes are kept per page
+                page[2][key] = count
+                self.shapes[key][3] += 1
+                repeats.append((key[0], key[1], count))
+        self.pages[label] = page
+        return repeats
+
+    def merge(self, other):
+        """
+        combine with a profile from another process
+        """
+        for label, (count, seconds, repeats) in other.pages.items():
+            page = self.pages.setdefault(label, [0, 0.0, {}])
+            page[0] += count
+            page[1] += seconds
+            page[2].update(repeats)
+        for key, values in other.shapes.items():
+            shape = self.shapes.setdefault(key, [0, 0.0, 0, 0])
+            for i, v in enumerate(values):
+                shape[i] += v
+
+    def report_lines(self):
+        total_queries = sum(x[0] for x in self.pages.values())
+        total_time = sum(x[1] for x in self.pages.values())
+        yield "{0:,} queries ({1:.2f}s) over {2:,} pages".format(
+            total_queries, total_time, len(self.pages)
+        )
+        yield ""
+
+        yield "Repeated statements (>= {0} times on a page)".format(self.threshold)
+        repeated = [(k, v) for k, v in self.shapes.items() if v[3]]
+        repeated.sort(key=lambda x: (x[1][3], x[1][0]), reverse=True)
+        for (shape, site), (count, seconds, pages, repeated_on) in repeated[
+            :REPORT_ROWS
+        ]:
+            yield "  {0:,} pages, {1:,} queries, {2:.2f}s  {3}".format(
+                repeated_on, count, seconds, site
+            )
+            yield "    {0}".format(shape)
+        yield ""
+
+        yield "Worst pages by query count"
+        worst = sorted(
+            self.pages.items(), key=lambda x: (x[1][0], x[1][1]), reverse=True
+        )
+        for label, (count, seconds, repeats) in worst[:REPORT_ROWS]:
+            yield "  {0:,} queries, {1:.3f}s  {2}".format(count, seconds, label)
+            for (shape, site), repeat_count in sorted(
+                repeats.items(), key=lambda x: x[1], reverse=True
+            ):
+                yield "    x{0} {1}".format(repeat_count, site)
+        yield ""
+
+        yield "Query shapes by total time"
+        shapes = sorted(self.shapes.items(), key=lambda x: x[1][1], reverse=True)
+        for (shape, site), (count, seconds, pages, repeated_on) in shapes[:REPORT_ROWS]:
+            yield "  {0:.2f}s, {1:,} queries on {2:,} pages  {3}".format(
+                seconds, count, pages, site
+            )
+            yield "    {0}".format(shape)
+
+    def write(self, path=None):
+        if path is None:
+            path = settings.SQL_PROFILE_REPORT
+        with open(path, "w") as f:
+            for line in self.report_lines():
+                f.write(line + "\n")
+        return path
+
+
+def print_repeats(label, repeats):
+    for shape, site, count in repeats:
+        print("repeated query x{0} on {1} from {2}".format(count, label, site))
+
+
+class SQLProfileMiddleware(object):
+    """
+    profile each request to the development server
+    the report is rewritten after every request
+    """
+
+    def __init__(self, get_response):
+        if not profiling_enabled():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.profile = SQLProfile()
+
+    def __call__(self, request):
+        with capture_queries() as queries:
+            response = self.get_response(request)
+        print_repeats(request.path, self.profile.add_page(request.path, queries))
+        self.profile.write()
+        return response
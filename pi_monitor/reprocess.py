@@ -1,71 +1,96 @@
 """
-reformat wdtk data to match scottish ids
-"""
-
-import pandas as pd
-from collections import Counter
-import os
-
-resources_folder = r"C:\Users\alexj\Dropbox\mysociety\research_sites\resources\foisa"
+count WhatDoTheyKnow requests per public body and year
+from the info_request.csv dump, for the wdtk_year_count.csv
+files the adapters read
 
+The dump is read once, in chunks, so memory depends on the number of
+bodies and years rather than the size of the dump.
 
-def get_wdtk_to_scottish_id():
-    path = os.path.join(resources_folder, "authorities.csv")
-    df = pd.read_csv(path)
-
-    lookup = {}
+    python -m pi_monitor.reprocess path/to/info_request.csv resources/foisa resources/cabinetfoi
+"""
 
-    for index, row in df.iterrows():
-        osic = int(row["authority_id"])
+import argparse
+import os
+from collections import Counter
 
-        for x in range(1, 12):
-            col = "wdtk_id_{0}".format(x)
-            if col in row and pd.notna(row[col]) and str(row[col]).strip():
-                try:
-                    lookup[int(row[col])] = osic
-                except (ValueError, TypeError):
-                    pass  # Skip invalid values
+import pandas as pd
 
-    return lookup
+CHUNK_SIZE = 500000
+# cabinetfoi has one wdtk_id column, foisa has wdtk_id_1 to wdtk_id_11
+WDTK_ID_COLUMNS = ["wdtk_id"] + ["wdtk_id_{0}".format(x) for x in range(1, 12)]
 
 
-def create_wdtk_count(year=2013):
-    path = os.path.join(resources_folder, "info_request.csv")
+def get_wdtk_lookup(resources_folder):
+    """
+    map of wdtk public body ids to the jurisdiction's authority ids
+    """
+    path = os.path.join(resources_folder, "authorities.csv")
     df = pd.read_csv(path)
-    lookup = get_wdtk_to_scottish_id()
-
-    # Convert public_body_id to numeric, handling errors
-    df["public_body_id"] = pd.to_numeric(df["public_body_id"], errors="coerce")
-
-    df["foisa"] = df["public_body_id"].apply(
-        lambda x: lookup.get(int(x), None) if pd.notna(x) else None
+    columns = [x for x in WDTK_ID_COLUMNS if x in df.columns]
+    if not columns:
+        raise ValueError("{0} has no wdtk_id columns".format(path))
+    df = df.melt(id_vars=["authority_id"], value_vars=columns, value_name="body_id")
+    df["body_id"] = pd.to_numeric(df["body_id"], errors="coerce")
+    df = df[df["body_id"].notnull()]
+    return dict(zip(df["body_id"].astype(int), df["authority_id"].astype(int)))
+
+
+def count_requests(path, chunksize=CHUNK_SIZE):
+    """
+    Counter of requests by (year, public_body_id), reading the dump once
+    """
+    counts = Counter()
+    chunks = pd.read_csv(
+        path, usecols=["public_body_id", "date_part"], dtype=str, chunksize=chunksize
     )
-
-    ids = []
-    for index, row in df.iterrows():
-        if year != "alltime" and str(row["date_part"]) != str(year):
-            continue
-        if pd.notna(row["foisa"]):
-            ids.append(row["foisa"])
-
-    c = Counter(ids)
-
-    # Create new DataFrame with results
-    result_data = []
-    for k, v in c.items():
-        result_data.append([k, year, v])
-
-    final = pd.DataFrame(result_data, columns=["authority_id", "year", "count"])
-
-    output_path = os.path.join(resources_folder, "wdtk_{0}.csv".format(year))
-    final.to_csv(output_path, index=False)
-
-
-def create_counts():
-    years = list(range(2013, 2020)) + ["alltime"]
-    for y in years:
-        create_wdtk_count(y)
+    rows = 0
+    for chunk in chunks:
+        rows += len(chunk)
+        chunk = chunk.apply(lambda x: pd.to_numeric(x.str.strip(), errors="coerce"))
+        chunk = chunk.dropna()
+        sizes = chunk.groupby(["date_part", "public_body_id"]).size()
+        counts.update(
+            {(int(year), int(body)): int(n) for (year, body), n in sizes.items()}
+        )
+        print("read {0:,} requests".format(rows), flush=True)
+    return counts
+
+
+def write_year_counts(counts, resources_folder):
+    """
+    write the counts for bodies the jurisdiction's authorities cover
+    returns the request count for each year and all time
+    """
+    lookup = get_wdtk_lookup(resources_folder)
+    rows = [
+        (year, body, n) for (year, body), n in sorted(counts.items()) if body in lookup
+    ]
+    df = pd.DataFrame(rows, columns=["year", "public_body_id", "count"])
+
+    path = os.path.join(resources_folder, "wdtk_year_count.csv")
+    df.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+    totals = df.groupby("year")["count"].sum().to_dict()
+    totals["alltime"] = int(df["count"].sum())
+    return totals
+
+
+def create_counts(path, resources_folders, chunksize=CHUNK_SIZE):
+    counts = count_requests(path, chunksize)
+    for folder in resources_folders:
+        totals = write_year_counts(counts, folder)
+        print(
+            "{0}: {1}".format(
+                folder, ", ".join("{0} {1:,}".format(k, v) for k, v in totals.items())
+            )
+        )
 
 
 if __name__ == "__main__":
-    create_counts()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("info_requests", help="path to info_request.csv")
+    parser.add_argument("resources_folders", nargs="+")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    create_counts(args.info_requests, args.resources_folders, args.chunksize)
@@ -0,0 +1,135 @@
+"""
+Cache of rendered pages for the live server, and their ETags
+
+The data only changes when populate runs, and each populate that
+changes anything bumps DataGeneration. Responses are cached on
+(view, args, generation), so a repopulate means new keys and the
+entries for older generations are dropped the next time they're seen.
+
+There is always a bounded in-process LRU. If RESPONSE_CACHE_FOLDER is
+set, pages are also kept there, so processes serving the site share them.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+def cache_enabled():
+    return getattr(settings, "RESPONSE_CACHE", False)
+
+
+def cache_key(view_name, args, kwargs, query_string=""):
+    parts = [view_name, repr(tuple(args)), repr(sorted(kwargs.items())), query_string]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def page_etag(generation, key):
+    """
+    strong validator for a page - changes with the data generation,
+    and with the templates and code when the server restarts
+    """
+    from .bake import code_digest
+
+    h = hashlib.sha1("{0}|{1}|{2}".format(code_digest(), generation, key).encode())
+    return '"{0}"'.format(h.hexdigest())
+
+
+class CachedPage(object):
+    def __init__(self, content, content_type):
+        self.content = content
+        self.content_type = content_type
+
+    def response(self):
+        return HttpResponse(self.content, content_type=self.content_type)
+
+
+class ResponseCache(object):
+    """
+    pages for the current data generation
+    """
+
+    def __init__(self, size, folder=None):
+        self.size = size
+        self.folder = folder
+        self.generation = None
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def use_generation(self, generation):
+        """
+        drop everything cached for earlier generations
+        """
+        if generation == self.generation:
+            return
+        with self.lock:
+            self.pages.clear()
+            self.generation = generation
+        if self.folder and os.path.isdir(self.folder):
+            for name in os.listdir(self.folder):
+                if name.isdigit() and int(name) < generation:
+                    shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+
+    def page_path(self, key):
+        return os.path.join(self.folder, str(self.generation), key)
+
+    def get(self, generation, key):
+        self.use_generation(generation)
+        with self.lock:
+            page = self.pages.get(key)
+            if page:
+                self.pages.move_to_end(key)
+                return page
+        if self.folder:
+            page = self.read(key)
+            if page:
+                self.remember(key, page)
+                return page
+        return None
+
+    def set(self, generation, key, page):
+        self.use_generation(generation)
+        self.remember(key, page)
+        if self.folder:
+            self.write(key, page)
+
+    def remember(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+    def read(self, key):
+        path = self.page_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            content_type, content = f.read().split(b"\n", 1)
+        return CachedPage(content, content_type.decode("utf-8"))
+
+    def write(self, key, page):
+        path = self.page_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(page.content_type.encode("utf-8") + b"\n" + page.content)
+        os.replace(tmp, path)
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(
+            getattr(settings, "RESPONSE_CACHE_SIZE", 200),
+            getattr(settings, "RESPONSE_CACHE_FOLDER", None),
+        )
+    return _cache
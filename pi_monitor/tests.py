@@ -1 +1,618 @@
-# Create your tests here.
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.text import slugify
+
+import pandas as pd
+
+from .adapters import AdapterRegistry
+from .adapters.base import GenericAdapter, clean_numeric_block
+from .cube import remove_cube
+from .derived import DerivedProperties, ExpressionParser, tokenize
+from .models import (
+    Authority,
+    DataGeneration,
+    Jurisdiction,
+    Property,
+    StatsTrees,
+    TableDeleter,
+    Value,
+    Year,
+)
+
+
+class FixtureAdapter(GenericAdapter):
+    """
+    a made up year - two councils in one sector and a health board
+    in another, with the odd figure written as text
+    """
+
+    slug = "fixture"
+    name = "Fixture"
+    desc = "Fixture"
+    authority_name_column = "Authority"
+    overall_total_column = "Requests"
+    start_year = 2020
+    end_year = 2020
+
+    def structure_files(self):
+        return []
+
+    def year_files(self, year: int):
+        return []
+
+    def get_authorities(self):
+        return pd.DataFrame(
+            {
+                "authority_id": [1, 2, 3, 4, 5],
+                "Authority": [
+                    "Councils",
+                    "Health",
+                    "Council A",
+                    "Council B",
+                    "Board C",
+                ],
+                "sector": [None, None, "Councils", "Councils", "Health"],
+                "render_full": [1] * 5,
+            }
+        )
+
+    def get_year(self, year: int, authority_lookup: dict):
+        return pd.DataFrame(
+            {
+                "Authority": ["Council A", "Council B", "Board C"],
+                "Requests": [10, 20, 4],
+                "Granted": [6, 5, "3"],
+                "Refused": [2, 15, "-"],
+            }
+        )
+
+
+class OtherAdapter(FixtureAdapter):
+    slug = "other"
+    name = "Other"
+
+
+class NestedAdapter(FixtureAdapter):
+    """
+    the same year, with Council A in a sector inside Councils
+    """
+
+    slug = "nested"
+    name = "Nested"
+
+    def get_authorities(self):
+        df = super().get_authorities()
+        df.loc[df["Authority"] == "Council A", "sector"] = "Scottish Councils"
+        extra = {
+            "authority_id": 6,
+            "Authority": "Scottish Councils",
+            "sector": "Councils",
+            "render_full": 1,
+        }
+        return pd.concat([df, pd.DataFrame([extra])], ignore_index=True)
+
+
+def make_jurisdiction(slug):
+    """
+    a jurisdiction with the fixture's properties and authorities
+    and its year loaded
+    """
+    j = Jurisdiction.objects.create(name=slug, slug=slug)
+    Property.objects.create(
+        jurisdiction=j, local_id=1, name="Requests", slug="requests"
+    )
+    responses = Property.objects.create(
+        jurisdiction=j,
+        local_id=2,
+        name="Responses",
+        slug="responses",
+        dynamic="*children*",
+    )
+    for local_id, name in [(3, "Granted"), (4, "Refused")]:
+        Property.objects.create(
+            jurisdiction=j,
+            local_id=local_id,
+            name=name,
+            slug=slugify(name),
+            child_of=responses,
+        )
+
+    j.populate_authorities()
+
+    year = Year.objects.create(jurisdiction=j, number=2020, display="2020", slug="2020")
+    year.load_year()
+    return j
+
+
+class FixtureTestCase(TestCase):
+    """
+    registers the fixture adapters, with cubes kept in a temporary folder
+    and no table cache
+    """
+
+    adapters = [FixtureAdapter, OtherAdapter, NestedAdapter]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cube_location = tempfile.mkdtemp()
+        cls.fixture_settings = override_settings(
+            CUBE_LOCATION=cls.cube_location, ADAPTER_TABLE_CACHE=None
+        )
+        cls.fixture_settings.enable()
+        for adapter in cls.adapters:
+            AdapterRegistry.register(adapter)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for adapter in cls.adapters:
+            AdapterRegistry.registry.pop(adapter.slug, None)
+            remove_cube(adapter.slug)
+        cls.fixture_settings.disable()
+        shutil.rmtree(cls.cube_location, ignore_errors=True)
+
+
+class ValueIndexTests(TestCase):
+    """
+    the common Value filters should be answered from an index
+    rather than by scanning the table
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.jurisdiction = Jurisdiction.objects.create(name="Test", slug="test")
+        j = cls.jurisdiction
+        cls.overall = Authority.objects.create(
+            jurisdiction=j, name="All Authorities", slug="all", is_overall=True
+        )
+        cls.body = Authority.objects.create(
+            jurisdiction=j, name="Body", slug="body", sector=cls.overall
+        )
+        cls.property = Property.objects.create(jurisdiction=j, name="Requests")
+        cls.year = Year.objects.create(
+            jurisdiction=j, number=2020, display="2020", slug="2020"
+        )
+        rows = pd.DataFrame(
+            {
+                "authority_id": [cls.overall.id, cls.body.id],
+                "property_id": [cls.property.id, cls.property.id],
+                "value": [10.0, 10.0],
+            }
+        )
+        Value.bulk_insert(cls.year, rows)
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_cube_filter(self):
+        queryset = Value.objects.filter(jurisdiction=self.jurisdiction)
+        self.assertUsesIndex(queryset, "value_jurisdiction_year")
+
+    def test_authority_stats(self):
+        queryset = Value.objects.filter(
+            authority=self.body, year_number=self.year.number
+        )
+        self.assertUsesIndex(queryset, "value_authority_year")
+
+    def test_parent_value(self):
+        queryset = Value.objects.filter(
+            authority_id=self.body.sector_id,
+            year_number=self.year.number,
+            property_id=self.property.id,
+        )
+        self.assertUsesIndex(queryset, "value_authority_year")
+
+    def test_bulk_insert_fills_year_columns(self):
+        values = Value.objects.filter(year=self.year)
+        self.assertEqual(values.count(), 2)
+        for value in values:
+            self.assertEqual(value.jurisdiction_id, self.jurisdiction.id)
+            self.assertEqual(value.year_number, self.year.number)
+
+
+class BuildYearTests(FixtureTestCase):
+    """
+    the values populate writes for a year, worked out by hand
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.jurisdiction = make_jurisdiction("fixture")
+
+    def assertValues(self, authority, expected):
+        for name, (value, percentage) in expected.items():
+            v = Value.objects.get(
+                jurisdiction=self.jurisdiction,
+                authority__name=authority,
+                property__name=name,
+                year_number=2020,
+            )
+            self.assertEqual(v.value, value, (authority, name))
+            self.assertAlmostEqual(
+                v.percentage_value, percentage, msg=(authority, name)
+            )
+
+    def test_authority_values(self):
+        self.assertValues(
+            "Council A",
+            {
+                "Requests": (10, 0),
+                "Responses": (8, 0),
+                "Granted": (6, 0.75),
+                "Refused": (2, 0.25),
+            },
+        )
+        # "3" and "-" in the file
+        self.assertValues(
+            "Board C",
+            {
+                "Requests": (4, 0),
+                "Responses": (3, 0),
+                "Granted": (3, 1),
+                "Refused": (0, 0),
+            },
+        )
+
+    def test_sector_values(self):
+        self.assertValues(
+            "Councils",
+            {
+                "Requests": (30, 0),
+                "Responses": (28, 0),
+                "Granted": (11, 11 / 28),
+                "Refused": (17, 17 / 28),
+            },
+        )
+        self.assertValues(
+            "Health",
+            {
+                "Requests": (4, 0),
+                "Responses": (3, 0),
+                "Granted": (3, 1),
+                "Refused": (0, 0),
+            },
+        )
+
+    def test_overall_values(self):
+        self.assertValues(
+            "All Authorities",
+            {
+                "Requests": (34, 0),
+                "Responses": (31, 0),
+                "Granted": (14, 14 / 31),
+                "Refused": (17, 17 / 31),
+            },
+        )
+
+    def test_every_authority_and_property(self):
+        values = Value.objects.filter(jurisdiction=self.jurisdiction)
+        self.assertEqual(values.count(), 6 * 4)
+
+
+class DryRunTests(FixtureTestCase):
+    """
+    a dry run reports what populate would rebuild and writes nothing
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # fixture is loaded and its 2020 is current, other doesn't exist yet
+        j = make_jurisdiction("fixture")
+        adapter = j.adapter()
+        j.input_digest = adapter.structure_digest()
+        j.save()
+        j.years.update(input_digest=adapter.year_digest(2020))
+
+    def counts(self):
+        return [x.objects.count() for x in [Jurisdiction, Year, Value, DataGeneration]]
+
+    def test_dry_run(self):
+        before = self.counts()
+        adapters = {x.slug: x for x in self.adapters}
+        with mock.patch.dict(AdapterRegistry.registry, adapters, clear=True):
+            plan = Jurisdiction.populate(dry_run=True)
+        plan = {x["slug"]: x for x in plan}
+
+        self.assertFalse(plan["fixture"]["rebuild"])
+        self.assertEqual(list(plan["fixture"]["years"]), [9999])
+        self.assertTrue(plan["other"]["rebuild"])
+        self.assertEqual(sorted(plan["other"]["years"]), [2020, 9999])
+
+        self.assertEqual(self.counts(), before)
+        self.assertEqual(os.listdir(self.cube_location), [])
+
+
+class DerivedPropertyTests(SimpleTestCase):
+    """
+    combo_of expressions - parsing, ordering and evaluation
+    """
+
+    slugs = {"requests": 1, "granted": 2, "refused": 3}
+
+    def parse(self, expression):
+        return ExpressionParser(expression, self.slugs).parse()
+
+    def evaluate(self, definitions, values):
+        """
+        definitions are (property_id, combo_of) pairs, added to the
+        properties above as derived_<id>
+        values are {(authority_id, property_id): value}
+        """
+        properties = [(i, slug, None, []) for slug, i in self.slugs.items()]
+        properties += [(i, "derived_{0}".format(i), c, []) for i, c in definitions]
+        rows = pd.DataFrame(
+            [(a, p, v) for (a, p), v in values.items()],
+            columns=["authority_id", "property_id", "value"],
+        )
+        result = DerivedProperties(properties).evaluate(rows)
+        return {(r.authority_id, r.property_id): r.value for r in result.itertuples()}
+
+    def test_tokenize(self):
+        self.assertEqual(
+            tokenize("Granted + 2.5*(refused)"),
+            [
+                ("slug", "granted"),
+                ("op", "+"),
+                ("num", 2.5),
+                ("op", "*"),
+                ("op", "("),
+                ("slug", "refused"),
+                ("op", ")"),
+            ],
+        )
+        # slugs can start with a number
+        self.assertEqual(
+            tokenize("20_day_deadline_met - 1"),
+            [("slug", "20_day_deadline_met"), ("op", "-"), ("num", 1.0)],
+        )
+        with self.assertRaises(ValueError):
+            tokenize("granted % 2")
+
+    def test_precedence(self):
+        self.assertEqual(
+            self.parse("requests + granted * 2"),
+            ("+", ("prop", 1), ("*", ("prop", 2), ("num", 2.0))),
+        )
+        self.assertEqual(
+            self.parse("requests - granted - refused"),
+            ("-", ("-", ("prop", 1), ("prop", 2)), ("prop", 3)),
+        )
+
+    def test_brackets(self):
+        self.assertEqual(
+            self.parse("(requests + granted) * 2"),
+            ("*", ("+", ("prop", 1), ("prop", 2)), ("num", 2.0)),
+        )
+        self.assertEqual(self.parse("-(granted)"), ("neg", ("prop", 2)))
+        with self.assertRaisesRegex(ValueError, "Missing"):
+            self.parse("(requests + granted")
+        with self.assertRaisesRegex(ValueError, "Unexpected"):
+            self.parse("requests + granted)")
+
+    def test_unknown_slug(self):
+        with self.assertRaisesRegex(ValueError, "Unknown property 'withdrawn'"):
+            self.parse("requests - withdrawn")
+
+    def test_cycle(self):
+        with self.assertRaisesRegex(ValueError, "depends on itself"):
+            self.evaluate([(10, "derived_11 + requests"), (11, "derived_10 * 2")], {})
+
+    def test_dependency_order(self):
+        # 11 is listed first but needs 10
+        values = self.evaluate(
+            [(11, "derived_10 * 2"), (10, "granted + refused")],
+            {(1, 2): 3, (1, 3): 4},
+        )
+        self.assertEqual(values[(1, 10)], 7)
+        self.assertEqual(values[(1, 11)], 14)
+
+    def test_division_by_zero_and_missing_values(self):
+        # authority 2 has no refused value, and nothing has requests
+        values = self.evaluate(
+            [(10, "granted / refused"), (11, "requests + granted")],
+            {(1, 2): 3, (1, 3): 4, (2, 2): 5},
+        )
+        self.assertEqual(values[(1, 10)], 0.75)
+        self.assertEqual(values[(2, 10)], 0)
+        self.assertEqual(values[(1, 11)], 3)
+        self.assertEqual(values[(2, 11)], 5)
+
+
+class StatsTreeTests(FixtureTestCase):
+    """
+    the stats trees built for every authority in a year at once
+    match the ones built a page at a time
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.jurisdiction = make_jurisdiction("fixture")
+        cls.year = cls.jurisdiction.years.get(number=2020)
+
+    def tables(self, tree):
+        return {
+            p.slug: p.table.df.sort_values("Property").reset_index(drop=True)
+            for p in tree
+        }
+
+    def test_same_as_single_page(self):
+        trees = StatsTrees(self.jurisdiction, self.year)
+        for authority in self.jurisdiction.authorities.all():
+            single = self.tables(authority.prepare_stats_as_tree(self.year))
+            batch = self.tables(trees.tree_for(authority))
+            self.assertEqual(list(batch), list(single))
+            for slug, df in single.items():
+                pd.testing.assert_frame_equal(
+                    batch[slug],
+                    df,
+                    check_dtype=False,
+                    obj="{0} {1}".format(authority.name, slug),
+                )
+
+    def test_comparisons(self):
+        trees = StatsTrees(self.jurisdiction, self.year)
+        labels = {}
+        for authority in self.jurisdiction.authorities.all():
+            (responses,) = self.tables(trees.tree_for(authority)).values()
+            labels[authority.name] = list(responses.columns)
+        self.assertEqual(labels["All Authorities"], ["Property", "Value", "%"])
+        self.assertEqual(labels["Councils"], ["Property", "Value", "%", "Overall %"])
+        self.assertEqual(labels["Council A"], ["Property", "Value", "%", "Sector %"])
+
+
+class NestedSectorTests(FixtureTestCase):
+    """
+    sectors inside sectors are loaded from authorities.csv
+    and rolled up at every level
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.jurisdiction = make_jurisdiction("nested")
+
+    def authority(self, name):
+        return self.jurisdiction.authorities.get(name=name)
+
+    def requests(self, name):
+        return Value.objects.get(
+            authority=self.authority(name), property__name="Requests"
+        ).value
+
+    def test_tree(self):
+        overall = self.authority("All Authorities")
+        councils = self.authority("Councils")
+        scottish = self.authority("Scottish Councils")
+        self.assertEqual(councils.sector, overall)
+        self.assertEqual(scottish.sector, councils)
+        self.assertTrue(scottish.is_sector)
+        self.assertEqual(self.authority("Council A").sector, scottish)
+        self.assertEqual(self.authority("Council B").sector, councils)
+
+    def test_rollup(self):
+        self.assertEqual(self.requests("Scottish Councils"), 10)
+        self.assertEqual(self.requests("Councils"), 30)
+        self.assertEqual(self.requests("Health"), 4)
+        self.assertEqual(self.requests("All Authorities"), 34)
+
+
+class CleanNumericTests(SimpleTestCase):
+    """
+    coercing blocks of columns to numbers
+    """
+
+    def test_mixed_and_object_columns(self):
+        df = pd.DataFrame(
+            {
+                "name": ["x", "y", "z"],
+                "ints": pd.Series([1, 2, None], dtype=object),
+                "empty": pd.Series([None, None, None], dtype=object),
+                "text": [" 4", "-", "n/a"],
+                "floats": [1.5, 2.0, 3.0],
+                "mixed": [" 7 ", 8, ""],
+            }
+        )
+        columns = ["ints", "empty", "text", "floats", "mixed"]
+        block, counts = clean_numeric_block(df, columns)
+
+        self.assertEqual(list(block.columns), columns)
+        expected = pd.DataFrame(
+            {
+                "ints": [1.0, 2.0, None],
+                "empty": [None, None, None],
+                "text": [4.0, None, None],
+                "floats": [1.5, 2.0, 3.0],
+                "mixed": [7.0, 8.0, None],
+            },
+            dtype=float,
+        )
+        pd.testing.assert_frame_equal(block, expected)
+        # only "n/a" wasn't a number or a known blank
+        self.assertEqual(
+            counts, {"ints": 0, "empty": 0, "text": 1, "floats": 0, "mixed": 0}
+        )
+
+    def test_numeric_columns_untouched(self):
+        df = pd.DataFrame({"a": [1, 2], "b": [0.5, None]})
+        block, counts = clean_numeric_block(df, ["b", "a"])
+        pd.testing.assert_frame_equal(block, df[["b", "a"]])
+        self.assertEqual(counts, {"b": 0, "a": 0})
+
+
+class TableDeleterTests(FixtureTestCase):
+    """
+    the set based deletes leave the same rows as the ORM's cascades,
+    and never touch another jurisdiction
+    """
+
+    def snapshot(self):
+        """
+        every row left, without the database ids
+        """
+        values = Value.objects.values_list(
+            "jurisdiction__slug",
+            "authority__name",
+            "property__name",
+            "year_number",
+            "value",
+            "percentage_value",
+        )
+        return {
+            "jurisdictions": sorted(
+                Jurisdiction.objects.values_list("slug", flat=True)
+            ),
+            "years": sorted(Year.objects.values_list("jurisdiction__slug", "number")),
+            "authorities": sorted(
+                Authority.objects.values_list("jurisdiction__slug", "name")
+            ),
+            "properties": sorted(
+                Property.objects.values_list("jurisdiction__slug", "name")
+            ),
+            "values": sorted(values),
+        }
+
+    def repopulate(self, fast):
+        """
+        the deletes populate makes while rebuilding fixture, step by step
+        """
+        deleter = TableDeleter(fast=fast)
+        make_jurisdiction("other")
+        j = make_jurisdiction("fixture")
+        steps = []
+
+        j.years.get(number=2020).load_year(deleter=deleter)
+        steps.append(self.snapshot())
+        deleter.authorities(j)
+        steps.append(self.snapshot())
+        deleter.properties(j)
+        steps.append(self.snapshot())
+        deleter.years(j, [2020])
+        steps.append(self.snapshot())
+        deleter.jurisdiction(j)
+        steps.append(self.snapshot())
+        return steps
+
+    def test_same_rows_left(self):
+        results = {}
+        for fast in [False, True]:
+            savepoint = transaction.savepoint()
+            results[fast] = self.repopulate(fast)
+            transaction.savepoint_rollback(savepoint)
+        self.assertEqual(results[True], results[False])
+
+        reloaded, _, _, _, removed = results[True]
+        # reloading a year replaces its values rather than adding to them
+        self.assertEqual(len(reloaded["values"]), 2 * 6 * 4)
+        # only the other jurisdiction is left, all of it
+        self.assertEqual(removed["jurisdictions"], ["other"])
+        self.assertEqual(removed["years"], [("other", 2020)])
+        self.assertEqual(len(removed["authorities"]), 6)
+        self.assertEqual(len(removed["properties"]), 4)
+        self.assertEqual(len(removed["values"]), 6 * 4)
+        self.assertTrue(all(x[0] == "other" for x in removed["values"]))
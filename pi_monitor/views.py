@@ -4,27 +4,28 @@ import altair as alt
 import numpy as np
 import pandas as pd
 from research_common.charts import (
-    AltairChart,
     Table,
-    query_to_df,
     group_to_other,
     theme,
 )
 from research_common.views import AnchorChartsMixIn
 from django.conf import settings
-from django.db.models import Q
-from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.utils.html import conditional_escape
 from django_sourdough.views import LogicalSocialView
 
+from . import response_cache
+from .charts import AltairChart
+from .cube import year_number
 from .models import (
     Authority,
+    DataGeneration,
     Jurisdiction,
     Property,
-    Value,
+    StatsTrees,
     Year,
     fix_percentage,
-    get_link,
     intcomma,
 )
 
@@ -39,6 +40,52 @@ class GenericSocial(object):
 class LocalView(AnchorChartsMixIn, GenericSocial, LogicalSocialView):
     chart_storage_slug = "foi-monitor"
 
+    def dispatch(self, request, *args, **kwargs):
+        """
+        answer conditional requests before doing any work, and serve
+        pages from the response cache for the current data generation
+        """
+        if request.method not in ("GET", "HEAD"):
+            return super().dispatch(request, *args, **kwargs)
+
+        generation = DataGeneration.current()
+        key = response_cache.cache_key(
+            self.__class__.__name__, args, kwargs, request.META.get("QUERY_STRING", "")
+        )
+        etag = response_cache.page_etag(generation.number, key)
+        last_modified = int(generation.updated.timestamp())
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if not_modified is not None:
+            return not_modified
+
+        response = self.cached_dispatch(request, generation.number, key, args, kwargs)
+        if response.status_code == 200:
+            response["ETag"] = etag
+            response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def cached_dispatch(self, request, generation, key, args, kwargs):
+        if request.method != "GET" or not response_cache.cache_enabled():
+            return super().dispatch(request, *args, **kwargs)
+
+        cache = response_cache.get_cache()
+        page = cache.get(generation, key)
+        if page:
+            return page.response()
+
+        response = super().dispatch(request, *args, **kwargs)
+        if hasattr(response, "render") and not getattr(response, "is_rendered", True):
+            response.render()
+        if response.status_code == 200 and not response.streaming:
+            cache.set(
+                generation,
+                key,
+                response_cache.CachedPage(response.content, response["Content-Type"]),
+            )
+        return response
+
     def extra_params(self, context):
         params = super().extra_params(context)
         if hasattr(settings, "SITE_ROOT"):
@@ -50,6 +97,14 @@ class LocalView(AnchorChartsMixIn, GenericSocial, LogicalSocialView):
         params.update(extra)
         return params
 
+    def bake_inputs(self, *args):
+        """
+        what a baked page is made from, used to skip unchanged pages
+        by default everything in the jurisdiction named by the first arg
+        """
+        cube = Jurisdiction.objects.get(slug=args[0]).cube()
+        return [cube.labels_digest(), cube.digest()]
+
 
 class OverviewView(LocalView):
     template = "pi_monitor/overview.html"
@@ -59,6 +114,9 @@ class OverviewView(LocalView):
     page_title = "Public Information Statistics"
     share_description = "Explore FOI information for different jurisdictions"
 
+    def bake_inputs(self, *args):
+        return list(Jurisdiction.objects.order_by("name").values_list("name", "slug"))
+
     def logic(self):
         self.jurisdictions = Jurisdiction.objects.all().order_by("name")
 
@@ -78,6 +136,15 @@ class HomeView(LocalView):
         for j in Jurisdiction.objects.all():
             yield (j.slug,)
 
+    def bake_inputs(self, jurisdiction_slug):
+        jurisdiction = Jurisdiction.objects.get(slug=jurisdiction_slug)
+        cube = jurisdiction.cube()
+        return [
+            cube.labels_digest(),
+            cube.digest(),
+            jurisdiction.adapter().get_description(),
+        ]
+
     def logic(self):
         self.jurisdiction = Jurisdiction.objects.get(slug=self.jurisdiction_slug)
         self.desc = self.jurisdiction.adapter().get_description()
@@ -96,10 +163,7 @@ class HomeView(LocalView):
 
         title = "Change over time by sector ({0})".format(jurisdiction.geo_label())
 
-        year_values = Value.objects.filter(
-            authority__in=jurisdiction.sectors(), property__special="PI_ALL"
-        )
-        year_values = year_values.exclude(year__number=9999)
+        cube = jurisdiction.cube()
 
         chart = AltairChart(name=title, title=title, chart_type="line")
 
@@ -107,7 +171,13 @@ class HomeView(LocalView):
         chart.header["year__number"] = "Year"
         chart.header["value"] = "Public information requests"
 
-        df = chart.apply_query(year_values)
+        df = cube.query(
+            chart.header,
+            authorities=cube.sector_ids(),
+            properties=cube.special_ids("PI_ALL"),
+            exclude_years=[9999],
+        )
+        chart.df = df
 
         df = group_to_other(
             df,
@@ -150,11 +220,7 @@ class HomeView(LocalView):
             jurisdiction.geo_label()
         )
 
-        year_values = Value.objects.filter(
-            authority__in=jurisdiction.sectors(),
-            property__special="PI_ALL",
-            year__number=9999,
-        )
+        cube = jurisdiction.cube()
 
         chart = AltairChart(name=title, title=title, chart_type="bar")
 
@@ -165,7 +231,13 @@ class HomeView(LocalView):
         }
 
         chart.header = header
-        df = chart.apply_query(year_values)
+        df = cube.query(
+            header,
+            authorities=cube.sector_ids(),
+            properties=cube.special_ids("PI_ALL"),
+            years=[9999],
+        )
+        chart.df = df
 
         year_totals = (
             df.groupby(["Year"]).sum().to_dict()["Public information requests"]
@@ -208,13 +280,7 @@ class HomeView(LocalView):
 
         special_labels = ["{type}_ALL".format(type=x.upper()) for x in avaliable_types]
 
-        query = Value.objects.filter(
-            authority__jurisdiction=jurisdiction,
-            authority__is_overall=True,
-            property__special__in=special_labels,
-        )
-
-        query = query.exclude(year__number=9999)
+        cube = jurisdiction.cube()
 
         chart = AltairChart(name=title, title=title, chart_type="line")
 
@@ -225,7 +291,13 @@ class HomeView(LocalView):
             "value": "Information requests",
         }
 
-        df = chart.apply_query(query)
+        df = cube.query(
+            chart.header,
+            authorities=[cube.overall_id()],
+            properties=cube.special_ids(*special_labels),
+            exclude_years=[9999],
+        )
+        chart.df = df
 
         year_totals = df.groupby(["Year"]).sum().to_dict()["Information requests"]
 
@@ -281,15 +353,22 @@ class PropertyView(LocalView):
                         y.slug,
                     )
 
+    def bake_inputs(self, jurisdiction_slug, property_slug, year_slug):
+        cube = Jurisdiction.objects.get(slug=jurisdiction_slug).cube()
+        # over time charts use every year of the property
+        property_id = cube.property_id(property_slug)
+        return [cube.labels_digest(), cube.digest(properties=[property_id])]
+
     def logic(self):
         self.jurisdiction = Jurisdiction.objects.get(slug=self.jurisdiction_slug)
 
         self.property = Property.objects.get(
             jurisdiction=self.jurisdiction, slug=self.property_slug
         )
+        self.cube = self.jurisdiction.cube()
         self.years = self.jurisdiction.years.filter(
-            values__property=self.property
-        ).distinct()
+            number__in=self.cube.years_present(properties=[self.property.id])
+        )
         self.year = Year.objects.get(
             jurisdiction=self.jurisdiction, slug=self.year_slug
         )
@@ -308,48 +387,33 @@ class PropertyView(LocalView):
             # add new bar chart based on property and year
 
         self.sector_table = self.public_bodies_table(
-            self.property, self.year, "Sector", self.jurisdiction.sectors()
+            self.property, self.year, "Sector", self.cube.sector_ids()
         )
 
         self.authority_table = self.public_bodies_table(
-            self.property, self.year, "Authority", self.jurisdiction.bodies()
+            self.property, self.year, "Authority", self.cube.body_ids()
         )
 
-    def public_bodies_table(self, property, year, name, authority_query):
+    def public_bodies_table(self, property, year, name, authority_ids):
         table = Table(name="counts by " + property.name)
 
-        value_query = Value.objects.filter(
-            year=year, property=property, authority__in=authority_query
-        )
-
-        value_query = value_query.order_by("-value")
-
-        render_full = self.jurisdiction.authorities.filter(
-            render_full=True
-        ).values_list("slug", flat=True)
-
-        def authority_link(authority):
-            authority_url = reverse(
-                "pi.body",
-                args=(self.year.jurisdiction.slug, authority.slug, self.year.slug),
-            )
-            return get_link(authority.name, authority_url)
+        links = self.jurisdiction.links()
 
         def get_linked_value(row):
             body_slug = row[name]
             value = intcomma(int(row["Count"]))
-            if body_slug not in render_full:
+            if body_slug not in links.render_full:
                 return value
             else:
-                url = reverse(
+                return links.link(
+                    value,
                     "pi.bodystat",
-                    args=(self.jurisdiction.slug, body_slug, self.property.slug),
+                    self.jurisdiction.slug,
+                    body_slug,
+                    self.property.slug,
                 )
-                return get_link(value, url)
 
-        auth_links = {
-            x.slug: authority_link(x) for x in self.jurisdiction.authorities.all()
-        }
+        auth_links = links.body_links(self.year.slug)
 
         table.header["authority__slug"] = name
         if name == "Authority":
@@ -365,7 +429,13 @@ class PropertyView(LocalView):
 
         table.format_on_row["Count"] = get_linked_value
 
-        table.apply_query(value_query)
+        table.df = self.cube.query(
+            table.header,
+            authorities=authority_ids,
+            properties=[property.id],
+            years=[year.number],
+            order_by=["-value"],
+        )
         return table
 
     def property_over_time(self, item_property, percentage=False, year=None):
@@ -404,21 +474,17 @@ class PropertyView(LocalView):
 
         chart.header["authority__name"] = "Sector"
 
-        sectors = Authority.objects.filter(
-            Q(is_sector=True) | Q(is_overall=True),
-            jurisdiction=self.jurisdiction,
-        )
-
-        year_values = Value.objects.filter(
-            authority__in=sectors, property=item_property
-        ).order_by("year__number")
-
-        year_values = year_values.exclude(year__number=9999)
-
-        if year:
-            year_values = year_values.filter(year=year)
+        sectors = self.cube.sector_ids() + [self.cube.overall_id()]
 
-        df = chart.apply_query(year_values)
+        df = self.cube.query(
+            chart.header,
+            authorities=sectors,
+            properties=[item_property.id],
+            years=[year.number] if year else None,
+            exclude_years=[9999],
+            order_by=["year__number"],
+        )
+        chart.df = df
 
         # do bar charts by sector for each year.
         if year:
@@ -480,34 +546,37 @@ class YearView(LocalView):
                     y.slug,
                 )
 
+    def bake_inputs(self, jurisdiction_slug, year_slug):
+        cube = Jurisdiction.objects.get(slug=jurisdiction_slug).cube()
+        return [cube.labels_digest(), cube.digest(years=[year_number(year_slug)])]
+
     def logic(self):
         self.jurisdiction = Jurisdiction.objects.get(slug=self.jurisdiction_slug)
         self.years = self.jurisdiction.years.all()
         self.year = self.years.get(slug=self.year_slug)
-        self.jurisdiction.adapter()
+        self.cube = self.jurisdiction.cube()
 
-        relevant_auths = Value.objects.filter(
-            year=self.year,
-            authority__is_overall=False,
-            authority__is_sector=False,
-            property__special="PI_ALL",
+        relevant_auths = self.cube.frame(
+            authorities=self.cube.body_ids(),
+            properties=self.cube.special_ids("PI_ALL"),
+            years=[self.year.number],
         )
 
-        relevant_auths = relevant_auths.exclude(value=0)
+        relevant_auths = relevant_auths[relevant_auths["value"] != 0]
 
-        values = [x.value for x in relevant_auths]
+        values = relevant_auths["value"].tolist()
         values.sort()
 
-        self.average = sum(values) / relevant_auths.count()
+        self.average = sum(values) / len(values)
         self.median = values[int(len(values) / 2)]
         self.max = values[-1]
-        self.relevant_auths = relevant_auths.count()
+        self.relevant_auths = len(values)
 
         self.authority = Authority.objects.get(
             jurisdiction=self.jurisdiction, is_overall=True
         )
-        self.authority.prepare_stats(self.year)
-        self.stats = self.authority.stats
+        self.stats = self.cube.special_values(self.authority.id, self.year.number)
+        self.authority.stats = self.stats
         self.sectors = self.jurisdiction.sectors()
         self.sector_chart = self.sector_distribution(self.year)
         self.sector_table = self.public_bodies_table(self.year, "Sector", self.sectors)
@@ -522,18 +591,7 @@ class YearView(LocalView):
         name expects either 'Public Bodies' or 'Sectors'
         """
 
-        # function to adapt link
-        def authority_link(authority):
-            """
-            generate an authority link
-            """
-            j_slug = self.year.jurisdiction.slug
-            year_slug = self.year.slug
-            authority_url = reverse("pi.body", args=(j_slug, authority.slug, year_slug))
-            return get_link(authority.name, authority_url)
-
-        valid_auths = self.jurisdiction.authorities.all()
-        auth_links = {x.slug: authority_link(x) for x in valid_auths}
+        auth_links = self.jurisdiction.links().body_links(self.year.slug)
 
         title = "FOI counts for " + year.display + " " + name
         table = Table(name=title)
@@ -558,16 +616,15 @@ class YearView(LocalView):
         df = table.apply_query(body_query)
 
         # get values and convert to pivot_table
-        values = Value.objects.filter(
-            property__special__in=needed_values, year=year, authority__in=body_query
-        )
-        values = query_to_df(
-            values,
+        values = self.cube.query(
             {
                 "property__name": "property",
                 "authority__slug": "authority",
                 "value": "value",
             },
+            authorities=list(body_query.values_list("id", flat=True)),
+            properties=self.cube.special_ids(*needed_values),
+            years=[year.number],
         )
         pivot = pd.pivot_table(
             values, values="value", index="authority", columns=["property"]
@@ -607,15 +664,16 @@ class YearView(LocalView):
         title = "Public information requests by sector"
         chart = AltairChart(name=title, title=title, chart_type="bar")
 
-        sectors = year.jurisdiction.sectors()
-
         chart.header["authority__name"] = "Sector"
         chart.header["value"] = "Public information requests"
 
-        year_values = Value.objects.filter(
-            year=year, authority__in=sectors, property__special="PI_ALL"
+        df = self.cube.query(
+            chart.header,
+            authorities=self.cube.sector_ids(),
+            properties=self.cube.special_ids("PI_ALL"),
+            years=[year.number],
         )
-        df = chart.apply_query(year_values)
+        chart.df = df
         pir = df["Public information requests"]
         df["Percentage"] = pir / pir.sum()
 
@@ -674,24 +732,34 @@ class BodyStatisticView(LocalView):
 
                     yield (j.slug, a.slug, p.slug, bake_variables)
 
+    def bake_inputs(self, jurisdiction_slug, body_slug, property_slug, bake_variables):
+        cube = Jurisdiction.objects.get(slug=jurisdiction_slug).cube()
+        authority_id = cube.authority_id(body_slug)
+        authorities = [authority_id, cube.overall_id()]
+        sector_id = cube.authorities.loc[authority_id, "sector_id"]
+        if pd.notnull(sector_id):
+            authorities.append(int(sector_id))
+        return [
+            cube.labels_digest(),
+            cube.digest(
+                authorities=authorities, properties=[cube.property_id(property_slug)]
+            ),
+        ]
+
     def load_from_bake(self):
         if self.bake_variables:
             for k, v in self.bake_variables.items():
                 setattr(self, k, v)
 
     def get_dataframe(self, authority, property=None):
+        cube = authority.jurisdiction.cube()
+
         sectors = [authority.id]
         if authority.sector_id:
             sectors.append(authority.sector_id)
-
-        year_values = Value.objects.filter(
-            Q(authority_id__in=sectors) | Q(authority__is_overall=True)
-        ).order_by("year__number")
-        if property:
-            year_values = year_values.filter(property=property)
-        year_values = year_values.exclude(year__number=9999).prefetch_related(
-            "year", "authority"
-        )
+        overall_id = cube.overall_id()
+        if overall_id not in sectors:
+            sectors.append(overall_id)
 
         header = {
             "year__number": "Year",
@@ -701,7 +769,13 @@ class BodyStatisticView(LocalView):
             "property_id": "property_id",
         }
 
-        main_df = query_to_df(year_values, header)
+        main_df = cube.query(
+            header,
+            authorities=sectors,
+            properties=[property.id] if property else None,
+            exclude_years=[9999],
+            order_by=["year__number"],
+        )
 
         return main_df
 
@@ -763,12 +837,16 @@ class BodyStatisticView(LocalView):
 
         table.df = df
 
+        links = self.jurisdiction.links()
+
         def format_year(year):
-            url = reverse(
+            return links.link(
+                int(year),
                 "pi.body",
-                args=(self.jurisdiction.slug, self.authority.slug, str(int(year))),
+                self.jurisdiction.slug,
+                self.authority.slug,
+                str(int(year)),
             )
-            return get_link(int(year), url)
 
         table.format["Year"] = format_year
         table.format["Value"] = lambda x: intcomma(int(x))
@@ -869,21 +947,45 @@ class BodyView(LocalView):
     template = "pi_monitor/body.html"
     url_patterns = [r"^(.*)/body/(.*)/(.*)/"]
     url_name = "pi.body"
-    args = ["jurisdiction_slug", "body_slug", "year_slug"]
+    args = ["jurisdiction_slug", "body_slug", "year_slug", ("bake_variables", {})]
     share_title = "Statistics - {{authority.name}}"
     page_title = "Statistics - {{authority.name}}"
     share_description = "{{jurisdiction.name}} - Information request statistics"
 
+    def _get_bake_path(self, *args):
+        args = args[:-1]  # remove the helper vars
+        return super()._get_bake_path(*args)
+
     def bake_args(self):
+        """
+        year by year, so the stats trees for all authorities in
+        a year can be made together
+        """
         for j in Jurisdiction.objects.all():
-            for a in j.authorities.all():
-                for y in a.valid_years():
+            cube = j.cube()
+            authorities = {a.id: a for a in j.authorities.all()}
+            for y in j.years.all():
+                print("fetching stats for {0}".format(y.slug))
+                bake_variables = {"stats_trees": StatsTrees(j, y)}
+                for authority_id in cube.authorities_present(y.number):
                     yield (
                         j.slug,
-                        a.slug,
+                        authorities[authority_id].slug,
                         y.slug,
+                        bake_variables,
                     )
 
+    def bake_inputs(self, jurisdiction_slug, body_slug, year_slug, bake_variables):
+        cube = Jurisdiction.objects.get(slug=jurisdiction_slug).cube()
+        # the chart and list of years cover every year of the authority
+        # and the stats compare it to its sector
+        authority_id = cube.authority_id(body_slug)
+        authorities = [authority_id]
+        sector_id = cube.authorities.loc[authority_id, "sector_id"]
+        if pd.notnull(sector_id):
+            authorities.append(int(sector_id))
+        return [cube.labels_digest(), cube.digest(authorities=authorities)]
+
     def logic(self):
         self.jurisdiction = Jurisdiction.objects.get(slug=self.jurisdiction_slug)
         self.authority = Authority.objects.get(
@@ -892,7 +994,11 @@ class BodyView(LocalView):
         self.years = self.authority.valid_years()
         self.year = self.years.get(slug=self.year_slug)
         self.chart = self.resolve_chart(self.authority)
-        self.stats_tree = self.authority.prepare_stats_as_tree(self.year)
+        if self.bake_variables:
+            trees = self.bake_variables["stats_trees"]
+            self.stats_tree = trees.tree_for(self.authority)
+        else:
+            self.stats_tree = self.authority.prepare_stats_as_tree(self.year)
         for s in self.stats_tree:
             self.chart_collection.register(s.table)
 
@@ -910,16 +1016,18 @@ class BodyView(LocalView):
 
         properties = ["PI_ALL", "PI_FULL"]
 
-        year_values = Value.objects.filter(
-            authority=authority, property__special__in=properties
-        )
-        year_values = year_values.exclude(year__number=9999)
+        cube = authority.jurisdiction.cube()
 
         chart.header["year__number"] = "Year"
         chart.header["property__name"] = "Series"
         chart.header["value"] = "Requests"
         chart.header["percentage_value"] = "% of Total"
-        chart.apply_query(year_values)
+        chart.df = cube.query(
+            chart.header,
+            authorities=[authority.id],
+            properties=cube.special_ids(*properties),
+            exclude_years=[9999],
+        )
 
         legend_options = alt.Legend(orient="bottom", labelLimit=300)
 
@@ -4,6 +4,7 @@ script for manually running various commands, not meant to be
 in regular use
 """
 
+import argparse
 import os
 
 try:
@@ -20,4 +21,32 @@ django.setup()
 from pi_monitor.populate import populate
 
 if __name__ == "__main__":
-    populate()
+    parser = argparse.ArgumentParser(description="Populate the database")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="build years in this many worker processes",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild everything, not just what the resource files changed",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="report what would be rebuilt without changing anything",
+    )
+    parser.add_argument(
+        "--fast-delete",
+        action="store_true",
+        help="clear old rows with set based DELETEs rather than the ORM",
+    )
+    args = parser.parse_args()
+    populate(
+        jobs=args.jobs,
+        full=args.full,
+        dry_run=args.dry_run,
+        fast_delete=args.fast_delete,
+    )
@@ -23,6 +23,28 @@ DATABASES = {
     },
 }
 
+# number of processes to split the bake across
+BAKE_WORKERS = int(os.environ.get("BAKE_WORKERS", "1"))
+
+# kept next to the baked site (but outside what's published)
+# so later bakes reuse specs for unchanged charts
+CHART_SPEC_CACHE = os.path.join(BAKE_LOCATION, ".chart_specs")
+
+# write chart data to json files named by their contents
+# rather than repeating it inline in every page
+CHART_DATA_FILES = os.environ.get("CHART_DATA_FILES", "FALSE").upper() == "TRUE"
+CHART_DATA_LOCATION = os.path.join(BAKE_MEDIA_LOCATION, "chart_data")
+CHART_DATA_URL = MEDIA_URL + "chart_data/"
+
+# every page is rendered once, so there's nothing to gain from caching
+RESPONSE_CACHE = False
+
+# the in-memory database is set to refuse writes while rendering
+BAKE_READ_ONLY = True
+
+# only re-render pages whose data, templates or view code have changed
+BAKE_INCREMENTAL = os.environ.get("BAKE_INCREMENTAL", "TRUE").upper() == "TRUE"
+
 MIDDLEWARE = (
     #'debug_toolbar.middleware.DebugToolbarMiddleware',
     #'django.contrib.sessions.middleware.SessionMiddleware',
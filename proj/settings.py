@@ -85,6 +85,32 @@ DATABASES = {
     },
 }
 
+# dense value arrays written by populate and read by the views
+CUBE_LOCATION = os.path.join(BASE_DIR, "databases", "cubes")
+
+# record every query made rendering a page (runserver and bake)
+# and report statements repeated SQL_PROFILE_THRESHOLD or more times on a page
+SQL_PROFILE = os.environ.get("SQL_PROFILE", "FALSE").upper() == "TRUE"
+SQL_PROFILE_THRESHOLD = int(os.environ.get("SQL_PROFILE_THRESHOLD", "5"))
+SQL_PROFILE_REPORT = os.path.join(BASE_DIR, "sql_profile.txt")
+
+# rendered pages are cached until populate next changes the data
+# RESPONSE_CACHE_FOLDER shares them between server processes
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "TRUE").upper() == "TRUE"
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "200"))
+RESPONSE_CACHE_FOLDER = os.environ.get("RESPONSE_CACHE_FOLDER") or None
+
+# folder for serialised chart specs, by hash of the chart's data and options
+# only set for the bake (see bake_settings) - nothing clears it out, so a
+# long running server keeps specs in memory (MEMORY_SPECS at most) instead
+CHART_SPEC_CACHE = None
+
+# cleaned adapter output for each year, reused while the input files
+# are unchanged (needs pyarrow)
+ADAPTER_TABLE_CACHE = None
+if os.environ.get("TABLE_CACHE", "TRUE").upper() == "TRUE":
+    ADAPTER_TABLE_CACHE = os.path.join(BASE_DIR, "databases", "tables")
+
 
 MIDDLEWARE = (
     "debug_toolbar.middleware.DebugToolbarMiddleware",
@@ -96,6 +122,7 @@ MIDDLEWARE = (
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "htmlmin.middleware.HtmlMinifyMiddleware",
     "htmlmin.middleware.MarkRequestMiddleware",
+    "pi_monitor.profiling.SQLProfileMiddleware",
 )
 
 